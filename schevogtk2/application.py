@@ -6,6 +6,8 @@
 import sys
 from schevo.lib import optimize
 
+import gobject
+
 from schevogtk2.navigator import NavigatorWindow
 
 
@@ -14,6 +16,9 @@ class Application(object):
     WindowClass = NavigatorWindow
 
     def __init__(self, window_class=None):
+        # Let worker threads run while the main loop is waiting for
+        # events.
+        gobject.threads_init()
         if window_class is None:
             window_class = self.WindowClass
         self.window = window_class()
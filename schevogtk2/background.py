@@ -0,0 +1,173 @@
+"""Background work that reports back to the GTK main loop.
+
+Worker threads only run while the main loop waits for events if
+`gobject.threads_init()` was called before the loop started, as
+`schevogtk2.application.Application` does.
+"""
+
+# Copyright (c) 2001-2009 ElevenCraft Inc.
+# See LICENSE for details.
+
+import sys
+from schevo.lib import optimize
+
+from collections import deque
+import threading
+import time
+from traceback import print_exception
+
+import gobject
+
+
+class Job(object):
+    """A unit of work submitted to a `Worker`."""
+
+    def __init__(self, func, args, callback, errback, done=None):
+        self.func = func
+        self.args = args
+        self.callback = callback
+        self.errback = errback
+        self.done = done
+        self.cancelled = False
+
+    def cancel(self):
+        """Prevent the job from running if it has not started, and its
+        callback or errback from being called if it has."""
+        self.cancelled = True
+
+
+class Worker(object):
+    """Thread that runs jobs one at a time, calling each job's
+    callback with its result, or its errback with the exception
+    information, from the main loop.
+
+    - `name`: Name of the thread.
+
+    - `lifo`: True if the most recently submitted job should run
+      first, for instance when newer requests are more likely to be
+      on screen.
+    """
+
+    def __init__(self, name, lifo=False):
+        self.name = name
+        self.lifo = lifo
+        self._condition = threading.Condition()
+        self._jobs = deque()
+        self._thread = None
+
+    def submit(self, func, args=(), callback=None, errback=None):
+        """Run `func(*args)` in the worker thread and return its `Job`."""
+        job = Job(func, args, callback, errback)
+        condition = self._condition
+        condition.acquire()
+        try:
+            self._jobs.append(job)
+            if self._thread is None:
+                thread = self._thread = threading.Thread(
+                    target=self._run, name=self.name)
+                thread.setDaemon(True)
+                thread.start()
+            condition.notify()
+        finally:
+            condition.release()
+        return job
+
+    def _next_job(self):
+        condition = self._condition
+        condition.acquire()
+        try:
+            jobs = self._jobs
+            while not jobs:
+                condition.wait()
+            if self.lifo:
+                return jobs.pop()
+            else:
+                return jobs.popleft()
+        finally:
+            condition.release()
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            if job.cancelled:
+                continue
+            try:
+                result = job.func(*job.args)
+            except:
+                gobject.idle_add(_deliver_error, job, sys.exc_info())
+            else:
+                gobject.idle_add(_deliver_result, job, result)
+
+
+def stream(func, args=(), callback=None, errback=None, done=None,
+           interval=0.1, budget=0.02):
+    """Iterate over the result of `func(*args)` from idle callbacks of
+    the main loop and return its `Job`.
+
+    Each idle callback iterates for about `budget` seconds, so that
+    the main loop keeps handling events, without any other thread
+    using what `func` reads from.
+
+    `callback` is called with lists of the items produced: the first
+    item as soon as it is produced, then the items produced in each
+    `interval` seconds.  `done` is called without arguments once all
+    items have been delivered.  If `func` or the iteration raises an
+    exception, `errback` is called as for `Worker.submit` and `done`
+    is not called.
+
+    Iteration stops when the job is cancelled.
+    """
+    job = Job(func, args, callback, errback, done)
+    def run():
+        try:
+            batch = []
+            deliver_at = 0
+            frame_end = time.time() + budget
+            for item in func(*args):
+                if job.cancelled:
+                    break
+                batch.append(item)
+                now = time.time()
+                if now >= deliver_at:
+                    _deliver_result(job, batch)
+                    batch = []
+                    deliver_at = now + interval
+                if now >= frame_end:
+                    yield True
+                    if job.cancelled:
+                        break
+                    frame_end = time.time() + budget
+        except:
+            _deliver_error(job, sys.exc_info())
+        else:
+            if batch:
+                _deliver_result(job, batch)
+            _deliver_done(job)
+        yield False
+    gobject.idle_add(run().next)
+    return job
+
+
+def _deliver_done(job):
+    if not job.cancelled and job.done is not None:
+        job.done()
+    # Remove the idle callback.
+    return False
+
+def _deliver_error(job, exc_info):
+    if not job.cancelled:
+        if job.errback is None:
+            print_exception(*exc_info)
+        else:
+            job.errback(*exc_info)
+    # Remove the idle callback.
+    return False
+
+def _deliver_result(job, result):
+    if not job.cancelled and job.callback is not None:
+        job.callback(result)
+    # Remove the idle callback.
+    return False
+
+
+optimize.bind_all(sys.modules[__name__])  # Last line of module.
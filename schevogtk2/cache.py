@@ -0,0 +1,124 @@
+"""Bounded caches shared by schevogtk2 widgets."""
+
+# Copyright (c) 2001-2009 ElevenCraft Inc.
+# See LICENSE for details.
+
+import sys
+from schevo.lib import optimize
+
+
+# Indexes into the linked-list nodes used by LRUCache.
+PREV = 0
+NEXT = 1
+KEY = 2
+VALUE = 3
+SIZE = 4
+
+
+class LRUCache(object):
+    """Dictionary-like mapping that discards the least recently used
+    items when full.
+
+    - `maxsize`: Maximum total size of the items held.
+
+    - `sizeof`: Function returning the size of a value; if not given,
+      each item has a size of 1, so `maxsize` is a number of items.
+    """
+
+    def __init__(self, maxsize=1000, sizeof=None):
+        self.maxsize = maxsize
+        self.sizeof = sizeof
+        self.size = 0
+        self._map = {}
+        # Circular doubly-linked list of [prev, next, key, value, size]
+        # nodes; the root's next node is the least recently used.
+        root = self._root = []
+        root[:] = [root, root, None, None, 0]
+
+    def __contains__(self, key):
+        return key in self._map
+
+    def __delitem__(self, key):
+        node = self._map.pop(key)
+        self._unlink(node)
+        self.size -= node[SIZE]
+
+    def __getitem__(self, key):
+        node = self._map[key]
+        self._touch(node)
+        return node[VALUE]
+
+    def __len__(self):
+        return len(self._map)
+
+    def __setitem__(self, key, value):
+        sizeof = self.sizeof
+        if sizeof is None:
+            size = 1
+        else:
+            size = sizeof(value)
+        node = self._map.get(key)
+        if node is not None:
+            self.size += size - node[SIZE]
+            node[VALUE] = value
+            node[SIZE] = size
+            self._touch(node)
+        else:
+            root = self._root
+            last = root[PREV]
+            node = [last, root, key, value, size]
+            last[NEXT] = root[PREV] = self._map[key] = node
+            self.size += size
+        # Discard the oldest items, but never the one just set.
+        root = self._root
+        while self.size > self.maxsize and root[NEXT] is not node:
+            oldest = root[NEXT]
+            self._unlink(oldest)
+            del self._map[oldest[KEY]]
+            self.size -= oldest[SIZE]
+
+    def clear(self):
+        self._map.clear()
+        self.size = 0
+        root = self._root
+        root[:] = [root, root, None, None, 0]
+
+    def discard(self, predicate):
+        """Remove every item whose key satisfies `predicate(key)`."""
+        for key in [key for key in self._map if predicate(key)]:
+            del self[key]
+
+    def get(self, key, default=None):
+        node = self._map.get(key)
+        if node is None:
+            return default
+        self._touch(node)
+        return node[VALUE]
+
+    def keys(self):
+        return self._map.keys()
+
+    def pop(self, key, default=None):
+        node = self._map.pop(key, None)
+        if node is None:
+            return default
+        self._unlink(node)
+        self.size -= node[SIZE]
+        return node[VALUE]
+
+    def _touch(self, node):
+        """Move `node` to the most recently used end of the list."""
+        self._unlink(node)
+        root = self._root
+        last = root[PREV]
+        node[PREV] = last
+        node[NEXT] = root
+        last[NEXT] = root[PREV] = node
+
+    def _unlink(self, node):
+        prev, next = node[PREV], node[NEXT]
+        prev[NEXT] = next
+        next[PREV] = prev
+
+
+optimize.bind_all(sys.modules[__name__])  # Last line of module.
@@ -0,0 +1,248 @@
+"""Lists and models of choices shared by the combo boxes of a database."""
+
+# Copyright (c) 2001-2009 ElevenCraft Inc.
+# See LICENSE for details.
+
+import sys
+from schevo.lib import optimize
+
+from bisect import bisect_left
+import weakref
+
+import gtk
+
+from schevo.constant import UNASSIGNED
+from schevo.label import label
+
+from schevogtk2.cache import LRUCache
+
+
+_db_map = weakref.WeakKeyDictionary()
+
+# Lists of valid values, keyed by the values, which do not change
+# with the database.
+_value_lists = LRUCache(100)
+
+# Models listing valid values, keyed by the values and the label of
+# the unassigned row.
+_value_models = LRUCache(100)
+
+
+class RowIndex(object):
+    """Index of the (text, data) rows of a combo box model, for finding
+    rows without scanning the model.
+
+    Rows are identified by their position in the model.
+    """
+
+    def __init__(self, rows):
+        prefixes = []
+        text_map = {}
+        data_map = {}
+        unhashable = []
+        for position, row in enumerate(rows):
+            text, data = row
+            if isinstance(text, basestring):
+                prefixes.append((text.lower(), position))
+                text_map.setdefault(text, position)
+            try:
+                data_map.setdefault(data, position)
+            except TypeError:
+                unhashable.append((data, position))
+        prefixes.sort()
+        # Lowercase texts, sorted, and the positions of their rows.
+        self._keys = [key for key, position in prefixes]
+        self._positions = [position for key, position in prefixes]
+        self._text_map = text_map
+        self._data_map = data_map
+        self._unhashable = unhashable
+
+    def find_data(self, data):
+        """Return the position of the first row holding `data`, or
+        None."""
+        try:
+            return self._data_map.get(data)
+        except TypeError:
+            for value, position in self._unhashable:
+                if value == data:
+                    return position
+
+    def find_only_prefix(self, prefix):
+        """Return the position of the row whose lowercase text starts
+        with `prefix`, or None if there is not exactly one such row."""
+        keys = self._keys
+        start = bisect_left(keys, prefix)
+        end = start + 1
+        if start < len(keys) and keys[start].startswith(prefix):
+            if end == len(keys) or not keys[end].startswith(prefix):
+                return self._positions[start]
+        return None
+
+    def find_text(self, text):
+        """Return the position of the first row with text `text`, or
+        None."""
+        return self._text_map.get(text)
+
+
+class ChoiceModel(object):
+    """Combo box model listing an unassigned row followed by a list of
+    choices, and the index of its rows.
+
+    Combo boxes listing the same choices display the same model
+    instead of each appending every row to a model of its own, so the
+    model must not be changed.
+    """
+
+    def __init__(self, choices, unassigned_label):
+        rows = [(unassigned_label, UNASSIGNED)]
+        rows.extend([row for row in choices if row[1] is not UNASSIGNED])
+        self.model = model = gtk.ListStore(str, object)
+        for row in rows:
+            model.append(row)
+        self.index = RowIndex(rows)
+
+    def __contains__(self, value):
+        return self.index.find_data(value) is not None
+
+
+class ChoiceCache(object):
+    """Sorted, labelled lists of the entities of extents, shared by
+    every combo box listing them.
+
+    Each extent has a change counter, incremented for every executed
+    transaction that creates, deletes or updates its entities.  Lists
+    are keyed by the counters of the extents they list, so a list
+    built before a change is never returned after it.
+
+    Labels may include the labels of referenced entities, so all lists
+    are discarded when any entity is updated or deleted.
+    """
+
+    def __init__(self):
+        self._revisions = {}
+        self._entity_lists = {}
+        self._entity_models = {}
+
+    def clear(self):
+        self._entity_lists.clear()
+        self._entity_models.clear()
+
+    def entity_choices(self, db, allow, entity_label):
+        """Return a tuple of (text, entity) pairs for the entities of
+        the extents named in `allow`, sorted within each extent.
+
+        - `entity_label`: Function returning the label of an entity.
+        """
+        key = self._key(allow, entity_label)
+        lists = self._entity_lists
+        choices = lists.get(key)
+        if choices is None:
+            items = []
+            allow_multiple = len(allow) > 1
+            for extent_name in allow:
+                extent = db.extent(extent_name)
+                if allow_multiple:
+                    extent_text = label(extent)
+                for entity in sorted(extent):
+                    if allow_multiple:
+                        text = u'%s :: %s' % (entity_label(entity),
+                                              extent_text)
+                    else:
+                        text = u'%s' % (entity_label(entity), )
+                    items.append((text, entity))
+            choices = lists[key] = tuple(items)
+        return choices
+
+    def entity_model(self, db, allow, entity_label, unassigned_label):
+        """Return the ChoiceModel listing `unassigned_label` followed
+        by the choices returned by `entity_choices`."""
+        key = self._key(allow, entity_label) + (unassigned_label, )
+        models = self._entity_models
+        choice_model = models.get(key)
+        if choice_model is None:
+            choices = self.entity_choices(db, allow, entity_label)
+            choice_model = models[key] = ChoiceModel(
+                choices, unassigned_label)
+        return choice_model
+
+    def reflect_changes(self, tx):
+        """Increment the change counters of the extents changed by the
+        executed transaction `tx`, and discard the lists that it may
+        have changed."""
+        summary = tx.s.summarize()
+        changed = set(summary.creates)
+        changed.update(summary.deletes)
+        changed.update(summary.updates)
+        if not changed:
+            return
+        revisions = self._revisions
+        for extent_name in changed:
+            revisions[extent_name] = revisions.get(extent_name, 0) + 1
+        if summary.updates or summary.deletes:
+            self.clear()
+            return
+        for mapping in (self._entity_lists, self._entity_models):
+            for key in mapping.keys():
+                for extent_name in key[0]:
+                    if extent_name in changed:
+                        del mapping[key]
+                        break
+
+    def _key(self, allow, entity_label):
+        revisions = self._revisions
+        return (tuple(allow), entity_label,
+                tuple([revisions.get(name, 0) for name in allow]))
+
+
+def get_cache(db):
+    """Return the choice cache of `db`."""
+    cache = _db_map.get(db)
+    if cache is None:
+        cache = _db_map[db] = ChoiceCache()
+    return cache
+
+
+def reflect_changes(db, tx):
+    """Update the choice cache of `db`, if any, to reflect the executed
+    transaction `tx`."""
+    cache = _db_map.get(db)
+    if cache is not None:
+        cache.reflect_changes(tx)
+
+
+def value_choices(valid_values):
+    """Return a tuple of (text, value) pairs for the sorted
+    `valid_values`."""
+    try:
+        key = tuple(valid_values)
+        hash(key)
+    except TypeError:
+        # Unhashable values cannot be looked up, so are not cached.
+        key = None
+    if key in _value_lists:
+        return _value_lists[key]
+    choices = tuple([(unicode(value), value)
+                     for value in sorted(valid_values)])
+    if key is not None:
+        _value_lists[key] = choices
+    return choices
+
+
+def value_model(valid_values, unassigned_label):
+    """Return a ChoiceModel listing `unassigned_label` followed by the
+    choices returned by `value_choices`."""
+    choices = value_choices(valid_values)
+    try:
+        key = (tuple(valid_values), unassigned_label)
+        hash(key)
+    except TypeError:
+        key = None
+    if key in _value_models:
+        return _value_models[key]
+    choice_model = ChoiceModel(choices, unassigned_label)
+    if key is not None:
+        _value_models[key] = choice_model
+    return choice_model
+
+
+optimize.bind_all(sys.modules[__name__])  # Last line of module.
@@ -0,0 +1,131 @@
+"""Cached counts of extents and relationships."""
+
+# Copyright (c) 2001-2009 ElevenCraft Inc.
+# See LICENSE for details.
+
+import sys
+from schevo.lib import optimize
+
+from collections import deque
+import time
+import weakref
+
+import gobject
+
+from schevo.error import EntityDoesNotExist
+
+
+_db_map = weakref.WeakKeyDictionary()
+
+
+class CountCache(object):
+    """Counts of the entities in extents and of the entities linking
+    to other entities, computed when the main loop is idle and then
+    kept up to date from the summaries of executed transactions."""
+
+    # Seconds spent counting in each idle callback.  Each count runs
+    # to completion once started, so a single large count may take
+    # longer.
+    frame_budget = 0.02
+
+    def __init__(self):
+        self._counts = {}
+        # Map of key to (count function, callbacks) for keys that have
+        # yet to be counted, and the keys in the order requested.
+        self._pending = {}
+        self._queue = deque()
+        self._source = None
+
+    def clear(self):
+        self._counts.clear()
+
+    def get(self, key, count, callback=None):
+        """Return the count for `key`, or None if it is not known yet.
+
+        - `count`: Function returning the count; called once the main
+          loop is idle, if the count is not known.
+
+        - `callback`: Function called with the count once it is known.
+        """
+        counts = self._counts
+        if key in counts:
+            return counts[key]
+        pending = self._pending
+        if key in pending:
+            callbacks = pending[key][1]
+        else:
+            callbacks = []
+            pending[key] = (count, callbacks)
+            self._queue.append(key)
+            if self._source is None:
+                self._source = gobject.idle_add(
+                    self._on_idle, priority=gobject.PRIORITY_LOW)
+        if callback is not None and callback not in callbacks:
+            callbacks.append(callback)
+        return None
+
+    def reflect_changes(self, tx):
+        """Update counts to reflect the executed transaction `tx`."""
+        summary = tx.s.summarize()
+        counts = self._counts
+        creates = summary.creates
+        deletes = summary.deletes
+        changed = set(creates)
+        changed.update(deletes)
+        changed.update(summary.updates)
+        for extent_name in changed:
+            key = extent_key(extent_name)
+            if key in counts:
+                counts[key] += (len(creates.get(extent_name, ()))
+                                - len(deletes.get(extent_name, ())))
+        # Any changed entity may have gained or lost a link, so count
+        # the links from changed extents again when next needed.
+        for key in counts.keys():
+            if key[0] == 'links' and key[3] in changed:
+                del counts[key]
+
+    def _on_idle(self):
+        deadline = time.time() + self.frame_budget
+        counts = self._counts
+        pending = self._pending
+        queue = self._queue
+        while queue:
+            key = queue.popleft()
+            count, callbacks = pending.pop(key)
+            try:
+                value = count()
+            except EntityDoesNotExist:
+                value = 0
+            counts[key] = value
+            for callback in callbacks:
+                callback(value)
+            if time.time() >= deadline:
+                break
+        if queue:
+            # Count the rest next time the main loop is idle.
+            return True
+        self._source = None
+        return False
+
+
+def extent_key(extent_name):
+    """Return the key for the count of entities in an extent."""
+    return ('extent', extent_name)
+
+
+def get_cache(db):
+    """Return the count cache of `db`."""
+    cache = _db_map.get(db)
+    if cache is None:
+        cache = _db_map[db] = CountCache()
+    return cache
+
+
+def links_key(entity, extent_name, field_name):
+    """Return the key for the count of entities in extent
+    `extent_name` whose field `field_name` refers to `entity`."""
+    return ('links', entity._extent.name, entity._oid, extent_name,
+            field_name)
+
+
+optimize.bind_all(sys.modules[__name__])  # Last line of module.
@@ -6,6 +6,8 @@
 import sys
 from schevo.lib import optimize
 
+import time
+
 from schevo import base
 from schevo import field
 from schevo.label import label, plural
@@ -17,8 +19,11 @@ from schevogtk2.action import (
     get_method_action, get_relationship_actions,
     get_tx_actions, get_tx_selectionmethod_actions,
     get_view_action, get_view_actions)
+from schevogtk2 import background
 from schevogtk2 import grid
 from schevogtk2 import icon
+from schevogtk2.labelcache import entity_label
+from schevogtk2.error import show_error
 from schevogtk2.utils import gsignal, type_register
 
 import gobject
@@ -40,10 +45,14 @@ class EntityColumn(grid.Column):
     def cell_icon(self, column, cell, model, row_iter):
         grid.Column.cell_icon(self, column, cell, model, row_iter)
         instance = model[row_iter][OBJECT_COLUMN]
-        try:
-            entity = getattr(instance, self.attribute)
-        except EntityDoesNotExist:
+        if instance is None:
+            # The entity of the row no longer exists.
             entity = UNASSIGNED
+        else:
+            try:
+                entity = getattr(instance, self.attribute)
+            except EntityDoesNotExist:
+                entity = UNASSIGNED
         if entity is UNASSIGNED:
             cell.set_property('stock_id', gtk.STOCK_NO)
             cell.set_property('stock_size', gtk.ICON_SIZE_SMALL_TOOLBAR)
@@ -54,6 +63,14 @@ class EntityColumn(grid.Column):
             cell.set_property('pixbuf', pixbuf)
             cell.set_property('visible', True)
 
+    def sort_key(self, instance):
+        # Sort by the text shown in the cell, computed once per row,
+        # rather than by comparing referenced entities.
+        entity = getattr(instance, self.attribute)
+        if entity is UNASSIGNED:
+            return u''
+        return entity_label(entity)
+
 
 class EntityGrid(grid.Grid):
 
@@ -61,12 +78,38 @@ class EntityGrid(grid.Grid):
 
     gsignal('action-selected', object)
 
+    # Show the first rows of large extents without waiting for the rest.
+    populate_incrementally = True
+
+    # Number of rows to add and remove above which refresh_add_delete
+    # replaces them all at once rather than one at a time.
+    bulk_refresh_threshold = 100
+
     # Set to False if 'Relationships' option should not show up in
     # popup menus.
     show_relationships_in_menu = True
 
     def __init__(self, model_info=None):
         grid.Grid.__init__(self)
+        # Create query status box.  Only show it while querying.
+        status_box = self._query_status_box = gtk.HBox()
+        status_box.props.spacing = 5
+        status_box.set_no_show_all(True)
+        self.pack_start(status_box, expand=False)
+        status_label = self._query_status_label = gtk.Label()
+        status_label.set_alignment(0.0, 0.5)
+        status_label.show()
+        status_box.pack_start(status_label)
+        cancel_button = self._query_cancel_button = gtk.Button(
+            stock=gtk.STOCK_CANCEL)
+        cancel_button.connect(
+            'clicked', self._on_query_cancel_button__clicked)
+        status_box.pack_start(cancel_button, expand=False)
+        self._query_count = 0
+        self._query_job = None
+        self._query_pending = []
+        self._query_start = None
+        self._query_timer = None
         self._hidden = []  # List of fieldnames of columns to hide.
         self._row_popup_menu = PopupMenu(self)
         self._set_bindings()
@@ -89,9 +132,16 @@ class EntityGrid(grid.Grid):
         self.set_selection_mode(gtk.SELECTION_MULTIPLE)
 
     def add_row(self, oid):
-        instance = self._extent[oid]
-        row_iter = grid.Grid.add_row(self, instance)
-        self._row_map[oid] = row_iter
+        self._add_key(oid, oid)
+
+    def cancel_query(self):
+        """Stop running the current query, keeping the rows of the
+        results that have arrived."""
+        if self._query_job is not None:
+            self._stop_query()
+            self._query_cancel_button.hide()
+            self._update_query_status(u'Cancelled after')
+        self.cancel_population()
 
     def columns_autosize_if_needed(self):
         # Resize columns if 25 or fewer rows.
@@ -99,8 +149,28 @@ class EntityGrid(grid.Grid):
         if len(model) <= 25:
             self._view.columns_autosize()
 
+    def get_row_instance(self, key):
+        if self._query is None:
+            # Rows of extent and related grids are keyed by OID.
+            return self._extent[key]
+        else:
+            # Query results may be views or entities of any extent,
+            # so they are kept rather than fetched again.
+            return self._results[key]
+
+    def get_row_key(self, instance):
+        return self.identify(instance)
+
+    def get_row_revision(self, instance):
+        if isinstance(instance, base.Entity):
+            return (self.identify(instance), instance._rev)
+
     def identify(self, instance):
-        return instance._oid
+        if self._query is None:
+            return instance._oid
+        # Query results may come from several extents, whose OIDs
+        # overlap.
+        return (instance._extent.name, instance._oid)
 
     def model_info(self):
         return (
@@ -115,10 +185,27 @@ class EntityGrid(grid.Grid):
 
     def reflect_changes(self, result, tx):
         if self._extent is not None:
+            extent_name = self._extent.name
             summary = tx.s.summarize()
-            for oid in summary.deletes.get(self._extent.name, []):
+            for oid in summary.deletes.get(extent_name, []):
                 self.remove_row(oid)
-            for oid in summary.creates.get(self._extent.name, []):
+            for name in summary.updates:
+                if name != extent_name:
+                    # Rendered references to entities of other extents
+                    # may now be out of date, and so may the sort keys
+                    # of columns showing them.
+                    self._cell_cache.clear()
+                    sort_keys = self._sort_keys
+                    for column in sort_keys.keys():
+                        if isinstance(column, EntityColumn):
+                            del sort_keys[column]
+                    if isinstance(self._sort_column, EntityColumn):
+                        self._sort_rows()
+                    self._view.queue_draw()
+                    break
+            for oid in summary.updates.get(extent_name, []):
+                self.invalidate_row(oid)
+            for oid in summary.creates.get(extent_name, []):
                 self.add_row(oid)
             if isinstance(result, self._extent.EntityClass):
                 self.select_row(result.s.oid)
@@ -137,37 +224,11 @@ class EntityGrid(grid.Grid):
                 self.set_query(None)
                 self.set_query(query)
             else:
-                # Get current selection identity so we can reselect it.
-                selected = self.get_selected()
-                rect = self._view.get_visible_rect()
-                if selected is None:
-                    identity = None
-                elif isinstance(selected, list):
-                    identity = [self.identify(entity) for entity in selected]
-                else:
-                    identity = self.identify(selected)
-                # Refresh query.
-                results = query()
-                self.set_rows([])
-                self.set_rows(results)
-                # Reselect the identity.
-                if identity is None:
-                    pass
-                elif isinstance(identity, list):
-                    self.select_rows(identity)
-                else:
-                    self.select_row(identity)
-                if rect.y == 0:
-                    rect_y = rect.y
-                else:
-                    # XXX: For some reason, if we are at the very end
-                    # of the scroll view, scrolling to the point will
-                    # cause the view to scroll to the very top. Take
-                    # one away from the Y coordinate so that this
-                    # doesn't happen.
-                    rect_y = rect.y - 1
-                if self._view.window:
-                    self._view.scroll_to_point(rect.x, rect_y)
+                results = []
+                self._run_query(
+                    query, results.extend, self._after_refresh, results)
+                # Rows are refreshed once the query is done.
+                return
         elif related is not None:
             if related.entity.s.exists:
                 if extent is not None:
@@ -184,37 +245,78 @@ class EntityGrid(grid.Grid):
         self.columns_autosize_if_needed()
 
     def refresh_add_delete(self, oids):
+        """Make the rows match the entities whose OIDs are in `oids`."""
+        # Rows still to be added are either in oids or deleted.
+        self.cancel_population()
         row_map = self._row_map
-        # Delete entities that no longer exist.
-        for oid in row_map.keys():
-            if oid not in oids:
-                self.remove_row(oid)
-        # Add new entities.
-        for oid in oids:
-            if oid not in row_map:
-                self.add_row(oid)
+        oids = list(oids)
+        wanted = set(oids)
+        deleted = [oid for oid in row_map if oid not in wanted]
+        added = [oid for oid in oids if oid not in row_map]
+        self._apply_row_changes(deleted, added)
+
+    def refresh_results(self, results):
+        """Make the rows match query `results`, replacing only the rows
+        that were added, removed or changed."""
+        # Rows still to be added are either in results or removed.
+        self.cancel_population()
+        identify = self.identify
+        old_results = self._results
+        new_results = {}
+        oids = []
+        for result in results:
+            oid = identify(result)
+            if oid not in new_results:
+                new_results[oid] = result
+                oids.append(oid)
+        row_map = self._row_map
+        deleted = []
+        changed = []
+        for oid in row_map:
+            result = new_results.get(oid)
+            if result is None:
+                deleted.append(oid)
+            elif result is not old_results[oid]:
+                old_rev = getattr(old_results[oid], '_rev', None)
+                new_rev = getattr(result, '_rev', None)
+                if old_rev is None or old_rev != new_rev:
+                    changed.append(oid)
+        added = [oid for oid in oids if oid not in row_map]
+        # Rows resolve their instances from here, so replace them
+        # before changing any rows.
+        self._results = new_results
+        for oid in changed:
+            self.invalidate_row(oid)
+        self._apply_row_changes(deleted, added)
 
     def remove_row(self, oid):
+        # Do not add the row later if it is still to be added.
+        self._pending_rows.pop(oid, None)
         if oid not in self._row_map:
             return
         model = self._model
-        row_iter = self._row_map.pop(oid)
+        key = self._row_map.pop(oid)
+        self._forget_row(oid, key)
         # Get the current position.
-        pos = model[row_iter].path[0]
+        pos = model.get_position(key)
         # Remove the instance.
-        model.remove(row_iter)
+        model.remove_key(key)
         # Select the next logical row, if any remain.
         end = len(model) - 1
         if pos > end:
             pos = end
         if pos > -1:
-            other = model[pos][OBJECT_COLUMN]
-            self.select(other)
+            row_iter = model.get_iter_for_key(model.get_key(pos))
+            self._view.get_selection().select_iter(row_iter)
+            self.select_and_focus_row(row_iter)
 
     def reset(self):
+        self._stop_query()
+        self._query_status_box.hide()
         self._extent = None
         self._query = None
         self._related = None
+        self._results = {}
         if self._row_popup_menu is not None:
             self._row_popup_menu.set_extent(None)
         self.set_rows([])
@@ -288,7 +390,7 @@ class EntityGrid(grid.Grid):
             self.select_action(v_action)
 
     def select_row(self, oid):
-        row_iter = self._row_map.get(oid, None)
+        row_iter = self._get_row_iter(oid)
         if row_iter is not None:
             self.select_and_focus_row(row_iter)
 
@@ -296,7 +398,7 @@ class EntityGrid(grid.Grid):
         selection = self._view.get_selection()
         first_row = None
         for oid in oids:
-            row_iter = self._row_map.get(oid, None)
+            row_iter = self._get_row_iter(oid)
             if row_iter is not None:
                 selection.select_iter(row_iter)
                 if first_row is None:
@@ -322,7 +424,7 @@ class EntityGrid(grid.Grid):
             self._row_popup_menu.set_extent(extent)
             columns = self._get_columns_for_field_spec(extent.field_spec)
             self.set_columns(columns)
-            self.set_rows(extent)
+            self.set_row_keys(extent.find_oids())
 
     def set_query(self, query):
         if query == self._query:
@@ -330,25 +432,7 @@ class EntityGrid(grid.Grid):
         self.reset()
         if query is not None:
             self._query = query
-            # For now, assume the results are homogenous and take the
-            # field_spec of the first result.
-            field_spec = None
-            results = query()
-            if not isinstance(results, list):
-                # Work around the fact that queries may return
-                # iterators by returning non-lists into lists.
-                results = list(results)
-            for result in results:
-                if field_spec is not None:
-                    break
-                if isinstance(result, base.Entity):
-                    field_spec = result._extent.field_spec
-                elif isinstance(result, base.View):
-                    field_spec = result._field_spec
-            if field_spec is not None:
-                columns = self._get_columns_for_field_spec(field_spec)
-                self.set_columns(columns)
-                self.set_rows(results)
+            self._run_query(query, self._add_query_results)
 
     def set_related(self, related):
         if related == self._related:
@@ -364,7 +448,24 @@ class EntityGrid(grid.Grid):
                 results = related.entity.s.links(extent.name,
                                                  related.field_name)
                 self.set_columns(columns)
-                self.set_rows(results)
+                self.set_row_keys([entity._oid for entity in results])
+
+    def set_rows(self, instances):
+        if self._query is None:
+            grid.Grid.set_rows(self, instances)
+        else:
+            # Rows of query results are keyed by extent name and OID,
+            # and the results themselves are kept here.  A result that
+            # is repeated gets a single row.
+            identify = self.identify
+            results = self._results = {}
+            oids = []
+            for instance in instances:
+                oid = identify(instance)
+                if oid not in results:
+                    results[oid] = instance
+                    oids.append(oid)
+            self.set_row_keys(oids)
 
     def _after_view__row_activated(self, view, path, column):
         row = self._model[path]
@@ -376,6 +477,80 @@ class EntityGrid(grid.Grid):
             ):
             self.emit('row-activated', entity)
 
+    def _add_query_results(self, results):
+        """Add rows for a batch of query `results`."""
+        pending = self._query_pending
+        pending.extend(results)
+        if not self._columns and not self._set_columns_for_results(pending):
+            # Keep results until one of them tells which columns to show.
+            return
+        self._query_pending = []
+        identify = self.identify
+        result_map = self._results
+        row_map = self._row_map
+        for result in pending:
+            oid = identify(result)
+            if oid not in row_map:
+                result_map[oid] = result
+                self._add_key(oid, oid)
+        self.columns_autosize_if_needed()
+
+    def _after_refresh(self, results):
+        self.refresh_results(results)
+        self.refilter()
+        self.columns_autosize_if_needed()
+
+    def _apply_row_changes(self, deleted, added):
+        """Remove the rows for the OIDs in `deleted` and add rows for
+        the OIDs in `added`, then restore the selection."""
+        if not (deleted or added):
+            return
+        model = self._model
+        row_map = self._row_map
+        # Remember the selection, and where it started, to restore it
+        # once all changes are made.
+        selected = self.get_selected()
+        if selected is None:
+            selected = []
+        elif not isinstance(selected, list):
+            selected = [selected]
+        selected = [self.identify(entity) for entity in selected
+                    if entity is not None]
+        if selected:
+            first_pos = model.get_position(row_map[selected[0]])
+        if len(deleted) + len(added) > self.bulk_refresh_threshold:
+            view = self._view
+            rect = view.get_visible_rect()
+            self.update_row_keys(deleted, [(oid, oid) for oid in added])
+            if view.window:
+                view.scroll_to_point(rect.x, rect.y)
+        else:
+            keys = []
+            for oid in deleted:
+                key = row_map.pop(oid)
+                self._forget_row(oid, key)
+                keys.append(key)
+            model.remove_keys(keys)
+            for oid in added:
+                self.add_row(oid)
+        if selected:
+            selected = [oid for oid in selected if oid in row_map]
+            if selected:
+                self.select_rows(selected)
+            elif len(model):
+                # Select the next logical row.
+                pos = min(first_pos, len(model) - 1)
+                row_iter = model.get_iter_for_key(model.get_key(pos))
+                self._view.get_selection().select_iter(row_iter)
+                self.select_and_focus_row(row_iter)
+
+    def _finish_query(self, after_done=None, *args):
+        self._stop_query()
+        self._query_cancel_button.hide()
+        self._update_query_status(u'Done in')
+        if after_done is not None:
+            after_done(*args)
+
     def _get_columns_for_field_spec(self, field_spec):
         columns = []
         if '_oid' not in self._hidden:
@@ -404,6 +579,28 @@ class EntityGrid(grid.Grid):
                 columns.append(column)
         return columns
 
+    def _run_query(self, query, on_results, after_done=None, *args):
+        """Run `query` from idle callbacks, calling `on_results` with
+        each batch of results and `after_done(*args)` once all have
+        arrived."""
+        self._stop_query()
+        self._query_count = 0
+        self._query_pending = []
+        self._query_start = time.time()
+        def deliver(results):
+            self._query_count += len(results)
+            self._update_query_status()
+            on_results(results)
+        def done():
+            self._finish_query(after_done, *args)
+        self._query_job = background.stream(
+            query, (), deliver, self._on_query__error, done)
+        self._query_timer = gobject.timeout_add(
+            100, self._on_query_timer__timeout)
+        self._update_query_status()
+        self._query_cancel_button.show()
+        self._query_status_box.show()
+
     def _set_bindings(self):
         items = [
             ('Insert', self.select_create_action),
@@ -419,6 +616,56 @@ class EntityGrid(grid.Grid):
             mod = mod | gtk.gdk.LOCK_MASK
             self._bindings[(keyval, mod)] = func
 
+    def _set_columns_for_results(self, results):
+        """Set columns for the first entity or view in `results`, and
+        return True, or return False if there is none."""
+        # For now, assume the results are homogenous and take the
+        # field_spec of the first result.
+        field_spec = None
+        for result in results:
+            if isinstance(result, base.Entity):
+                field_spec = result._extent.field_spec
+            elif isinstance(result, base.View):
+                field_spec = result._field_spec
+            if field_spec is not None:
+                columns = self._get_columns_for_field_spec(field_spec)
+                self.set_columns(columns)
+                return True
+        return False
+
+    def _stop_query(self):
+        job = self._query_job
+        if job is not None:
+            job.cancel()
+            self._query_job = None
+        timer = self._query_timer
+        if timer is not None:
+            gobject.source_remove(timer)
+            self._query_timer = None
+
+    def _update_query_status(self, prefix=u'Running for'):
+        seconds = time.time() - self._query_start
+        count = self._query_count
+        if count == 1:
+            text = u'%s %.1f s: 1 result.'
+        else:
+            text = u'%%s %%.1f s: %i results.' % count
+        self._query_status_label.set_text(text % (prefix, seconds))
+
+    def _on_query__error(self, exc_type, exc_val, exc_tb):
+        self._stop_query()
+        self._query_cancel_button.hide()
+        self._update_query_status(u'Failed after')
+        show_error(self.get_toplevel(), exc_type, exc_val, exc_tb)
+
+    def _on_query_cancel_button__clicked(self, button):
+        self.cancel_query()
+
+    def _on_query_timer__timeout(self):
+        self._update_query_status()
+        # Keep the timer running.
+        return True
+
 type_register(EntityGrid)
 
 
@@ -9,6 +9,7 @@ from schevo.lib import optimize
 from schevo.label import label, plural
 
 from schevogtk2 import action
+from schevogtk2 import counts
 from schevogtk2 import grid
 from schevogtk2 import icon
 from schevogtk2.utils import gsignal, type_register
@@ -45,7 +46,7 @@ class ExtentGrid(grid.Grid):
         columns = self._columns = []
         column = ExtentColumn(self, '_plural', 'Name', str)
         columns.append(column)
-        column = grid.Column(self, '__len__', 'Qty', int, call=True)
+        column = grid.CountColumn(self, 'Qty', extent_count_info)
         columns.append(column)
         self.set_columns(columns)
 
@@ -152,4 +153,8 @@ class PopupMenu(grid.PopupMenu):
         self._extent_grid.select_action(action)
 
 
+def extent_count_info(extent):
+    return extent.db, counts.extent_key(extent.name)
+
+
 optimize.bind_all(sys.modules[__name__])  # Last line of module.
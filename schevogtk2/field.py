@@ -20,6 +20,7 @@ from schevo.constant import UNASSIGNED
 
 from schevogtk2.constants import MONO_FONT
 from schevogtk2 import fieldwidget
+from schevogtk2 import imagecache
 from schevogtk2.utils import gsignal, type_register
 
 
@@ -27,6 +28,27 @@ from schevogtk2.utils import gsignal, type_register
 width, STANDARD_HEIGHT = gtk.ComboBoxEntry().size_request()
 
 
+# Positions of the handlers in get_value and set_field handler lists
+# to call for a class of widget or kind of field, keyed by the handlers
+# and the class or kind.  Handlers in TYPE_DISPATCHED_HANDLERS are left
+# out once seen to pass over the class or kind, and other handlers are
+# always called.
+_get_value_chains = {}
+_set_field_chains = {}
+
+
+def _field_key(field):
+    """Return the key of the kind of `field` that set_field handlers in
+    TYPE_DISPATCHED_HANDLERS create widgets for."""
+    return (
+        field.__class__,
+        bool(field.readonly),
+        bool(field.fget),
+        bool(getattr(field, 'multiline', False)),
+        field.valid_values is not None,
+        )
+
+
 class DynamicField(gtk.HBox):
 
     __gtype_name__ = 'DynamicField'
@@ -36,7 +58,8 @@ class DynamicField(gtk.HBox):
     gsignal('view-clicked', object)
     gsignal('value-changed')
 
-    def __init__(self, get_value_handlers, set_field_handlers):
+    def __init__(self, get_value_handlers, set_field_handlers,
+                 update_field_handlers=None):
         gtk.HBox.__init__(self)
         self.props.spacing = 5
         # Create the units label, hidden by default, packed to the end.
@@ -55,13 +78,69 @@ class DynamicField(gtk.HBox):
         self.expand = False
         self.get_value_handlers = get_value_handlers
         self.set_field_handlers = set_field_handlers
+        if update_field_handlers is None:
+            update_field_handlers = DEFAULT_UPDATE_FIELD_HANDLERS
+        self.update_field_handlers = update_field_handlers
+        # set_field handler that created the current widget.
+        self._set_field_handler = None
+        # True until `set_field` is called for the field given to
+        # `defer_field`.
+        self.deferred = False
+        # True while the widget is being updated in place, so that
+        # the changes made do not count as changes made by the user.
+        self._updating = False
+
+    def defer_field(self, db, field):
+        """Show an insensitive placeholder for `field` until
+        `set_field` is called for it, or it is reset while shown."""
+        self._db = db
+        self._field = field
+        self._set_field_handler = None
+        self.deferred = True
+        if self.child is not None and self.child.get_parent() is self:
+            self.remove(self.child)
+        widget = gtk.Entry()
+        widget.set_sensitive(False)
+        widget.show()
+        self.pack_start(widget)
+        self.child = widget
+        self._units_label.hide()
 
     def get_value(self):
+        if self.deferred:
+            # The placeholder holds no value.
+            return self._field.get()
         widget = self.child
-        for handler in self.get_value_handlers:
-            widget, cont, value = handler(widget)
+        handlers = tuple(self.get_value_handlers)
+        start = 0
+        while start < len(handlers):
+            # Call the handlers that may handle this class of widget,
+            # until one handles it or returns another widget.
+            chain_key = (handlers, start, widget.__class__)
+            chain = _get_value_chains.get(chain_key)
+            if chain is None:
+                chain = xrange(start, len(handlers))
+                compiled = []
+            else:
+                compiled = None
+            start = len(handlers)
+            next_widget, cont = widget, True
+            for position in chain:
+                handler = handlers[position]
+                next_widget, cont, value = handler(widget)
+                if compiled is not None and (
+                    not cont or next_widget is not widget
+                    or handler not in TYPE_DISPATCHED_HANDLERS
+                    ):
+                    compiled.append(position)
+                if not cont or next_widget is not widget:
+                    start = position + 1
+                    break
+            if compiled is not None:
+                _get_value_chains[chain_key] = tuple(compiled)
             if not cont:
                 return value
+            widget = next_widget
         # We couldn't find an endpoint handler.
         raise ValueError(
             'Could not find an endpoint get_value handler for %r' % self.child)
@@ -69,30 +148,79 @@ class DynamicField(gtk.HBox):
     def grab_focus(self):
         self.child.grab_focus()
 
+    def rebind(self, db, field):
+        """Return True if `field` is now shown by updating the current
+        widget in place, or False if `set_field` or `defer_field` must
+        be called for it.
+
+        The widget is updated if it was created for `field`, with its
+        metadata unchanged since, or for another field of the same
+        kind, such as the field of the same name of another instance
+        of a transaction.
+        """
+        if (db is not self._db or self.deferred or field.hidden
+            or self._set_field_handler is None
+            ):
+            return False
+        if field is self._field:
+            if field.metadata_changed:
+                return False
+        elif not self._is_same_kind(field):
+            return False
+        self._field = field
+        if not self._update_field():
+            return False
+        self._show_units()
+        return True
+
     def reset(self):
         field = self._field
         if field.hidden:
             return
+        if self.deferred:
+            self.set_field(self._db, field)
+            return
         field_value = field.get()
         widget_value = self.get_value()
         if (widget_value == field_value) and not field.metadata_changed:
             return
-        field.reset_metadata_changed()
         self.set_field(self._db, field)
+        field.reset_metadata_changed()
 
     def set_field(self, db, field):
+        if self.rebind(db, field):
+            # The widget shows the new value.
+            return
         self._db = db
         self._field = field
+        self.deferred = False
         if self.child is not None and self.child.get_parent() is self:
             self.remove(self.child)
+        self._set_field_handler = None
         if field.hidden:
             # Do nothing for hidden fields.
             return
         control = None
         change_cb = self._on_widget__value_changed
-        for handler in self.set_field_handlers:
+        # Call the handlers that may handle fields like this one.
+        handlers = tuple(self.set_field_handlers)
+        chain_key = (handlers, _field_key(field))
+        chain = _set_field_chains.get(chain_key)
+        if chain is None:
+            chain = xrange(len(handlers))
+            compiled = []
+        else:
+            compiled = None
+        for position in chain:
+            handler = handlers[position]
             cont, widget, control = handler(self, db, field, change_cb)
+            if compiled is not None and (
+                not cont or handler not in TYPE_DISPATCHED_HANDLERS):
+                compiled.append(position)
             if not cont:
+                if compiled is not None:
+                    _set_field_chains[chain_key] = tuple(compiled)
+                self._set_field_handler = handler
                 if control is None:
                     control = widget
                 if field.fget or field.readonly:
@@ -123,17 +251,60 @@ class DynamicField(gtk.HBox):
                     self.props.height_request = -1
                 self.pack_start(widget)
                 self.child = widget
-                # Hide or show units label as appropriate.
-                if field.units:
-                    self._units_label.show()
-                    self._units_label.set_text(field.units)
-                else:
-                    self._units_label.hide()
+                parent = self.get_parent()
+                if self.expand and isinstance(parent, gtk.Table):
+                    # Laid out before its widget was created.
+                    parent.child_set_property(
+                        self, 'y-options', gtk.EXPAND | gtk.FILL)
+                self._show_units()
                 return
+        if compiled is not None:
+            _set_field_chains[chain_key] = tuple(compiled)
         # We couldn't find an endpoint handler.
         raise ValueError(
             'Could not find an endpoint set_field handler for %r' % self.child)
 
+    def _is_same_kind(self, field):
+        """Return True if the set_field handlers would create the
+        current widget for `field` too."""
+        key = _field_key(field)
+        if key != _field_key(self._field):
+            return False
+        # Only handlers in TYPE_DISPATCHED_HANDLERS are known to
+        # choose the same widget for fields of the same kind.
+        handlers = tuple(self.set_field_handlers)
+        chain = _set_field_chains.get((handlers, key))
+        if not chain:
+            return False
+        for position in chain:
+            if handlers[position] not in TYPE_DISPATCHED_HANDLERS:
+                return False
+        return handlers[chain[-1]] is self._set_field_handler
+
+    def _show_units(self):
+        # Hide or show units label as appropriate.
+        field = self._field
+        if field.units:
+            self._units_label.show()
+            self._units_label.set_text(field.units)
+        else:
+            self._units_label.hide()
+
+    def _update_field(self):
+        """Return True if the current widget was updated in place to
+        show the value of the field."""
+        widget = self.child
+        if widget is None or widget.get_parent() is not self:
+            return False
+        update = self.update_field_handlers.get(self._set_field_handler)
+        if update is None:
+            return False
+        self._updating = True
+        try:
+            return update(self, self._db, self._field, widget)
+        finally:
+            self._updating = False
+
     def _on_widget__create_clicked(self, widget, allowed_extents, done_cb):
         self.emit('create-clicked', allowed_extents, done_cb)
 
@@ -141,6 +312,8 @@ class DynamicField(gtk.HBox):
         self.emit('update-clicked', entity_to_update, done_cb)
 
     def _on_widget__value_changed(self, widget, field):
+        if self._updating:
+            return
         value = self.get_value()
 ##         print '%s changed to: %s %r:' % (field.name, value, value)
         self.emit('value-changed')
@@ -347,14 +520,8 @@ def _set_field_rw_entity(container, db, field, change_cb):
 @optimize.do_not_optimize
 def _set_field_image(container, db, field, change_cb):
     if isinstance(field, schevo.field.Image):
-        value = field.value
         widget = gtk.Image()
-        if value is not UNASSIGNED:
-            loader = gtk.gdk.PixbufLoader()
-            loader.write(value)
-            loader.close()
-            pixbuf = loader.get_pixbuf()
-            widget.set_from_pixbuf(pixbuf)
+        _show_image(widget, field.value)
         return (False, widget, None)
     else:
         return (True, None, None)
@@ -453,6 +620,18 @@ def _set_field_generic(container, db, field, change_cb):
     widget.props.height_request = STANDARD_HEIGHT
     return (False, widget, None)
 
+def _show_image(widget, value):
+    if value is UNASSIGNED:
+        widget.clear()
+        return
+    # Shown empty until decoded.
+    def on_decoded(pixbuf):
+        widget.set_from_pixbuf(pixbuf)
+    pixbuf = imagecache.cache.get(
+        imagecache.data_key(value), lambda: value, None, on_decoded)
+    if pixbuf is not None:
+        widget.set_from_pixbuf(pixbuf)
+
 DEFAULT_SET_FIELD_HANDLERS = [
     _set_field_rw_boolean,
     _set_field_rw_entity,
@@ -466,4 +645,140 @@ DEFAULT_SET_FIELD_HANDLERS = [
     ]
 
 
+# update_field handlers show a new value in a widget created by a
+# set_field handler, without creating another widget.  They are only
+# used while the set_field handler chain would create the same kind of
+# widget, that is for the same field with its metadata unchanged, or
+# for another field of the same kind.  They are mapped to by the
+# set_field handlers whose widgets they update.
+#
+# update_field handlers accept the following positional arguments:
+#
+#   container: The widget containing the field widget.
+#   db:        The database the field is attached to.
+#   field:     The field to show, which the widget was created for or
+#              is of the same kind as the field it was created for.
+#   widget:    The field widget.
+#
+# update_field handlers return True if the widget now shows the value
+# of the field, or False if a new widget must be created.
+
+@optimize.do_not_optimize
+def _update_field_rw_boolean(container, db, field, widget):
+    value = field.value
+    if value is UNASSIGNED:
+        value = False
+    if isinstance(widget, fieldwidget.BooleanRadio):
+        widget.set_value(value)
+    else:
+        widget.set_active(value)
+    return True
+
+@optimize.do_not_optimize
+def _update_field_rw_entity(container, db, field, widget):
+    if widget.field is not field:
+        # List the entities allowed by the new field.
+        widget.set_field(field)
+        return True
+    # Entities not listed by the widget need a new widget.
+    value = field.value
+    widget.select_item_by_data(value)
+    return widget.get_selected() == value
+
+@optimize.do_not_optimize
+def _update_field_image(container, db, field, widget):
+    _show_image(widget, field.value)
+    return True
+
+@optimize.do_not_optimize
+def _update_field_multiline_string(container, db, field, widget):
+    value = field.value
+    if value is UNASSIGNED:
+        value = ''
+    else:
+        value = unicode(value)
+    widget.child.props.buffer.set_text(value)
+    return True
+
+@optimize.do_not_optimize
+def _update_field_calculated(container, db, field, widget):
+    value = field.value
+    if value is UNASSIGNED:
+        value = ''
+    else:
+        value = unicode(value)
+    _update_entry(widget, value)
+    return True
+
+@optimize.do_not_optimize
+def _update_field_rw_path(container, db, field, widget):
+    widget.field = field
+    value = field.value
+    if value:
+        widget.set_filename(value)
+        return True
+    # File choosers cannot be cleared.
+    return False
+
+@optimize.do_not_optimize
+def _update_field_ro_boolean(container, db, field, widget):
+    value = field.value
+    if value is UNASSIGNED:
+        value = field.unassigned_label
+    elif value == True:
+        value = field.true_description or field.true_label
+    else:
+        value = field.false_description or field.false_label
+    _update_entry(widget, value)
+    return True
+
+@optimize.do_not_optimize
+def _update_field_generic_valid_values(container, db, field, widget):
+    if widget.field is not field:
+        # List the values allowed by the new field.
+        widget.set_field(field)
+        return True
+    value = field.value
+    widget.select_item_by_data(value)
+    return widget.get_selected() == value
+
+@optimize.do_not_optimize
+def _update_field_generic(container, db, field, widget):
+    value = field.value
+    if value is UNASSIGNED:
+        value = ''
+    else:
+        value = unicode(value)
+    _update_entry(widget, value)
+    return True
+
+def _update_entry(entry, text):
+    # Leave the entry alone if it already shows the text, and keep
+    # the cursor where it was otherwise.
+    if entry.get_text().decode('utf-8') != text:
+        position = entry.get_position()
+        entry.set_text(text)
+        entry.set_position(min(position, len(text)))
+
+# Handlers that handle a widget, or pass it on, according to the class
+# of the widget only, or a field according to its class and whether it
+# is readonly, calculated, multiline or has valid values.  DynamicField
+# only calls each of them once for each class of widget or kind of
+# field they pass on; add custom handlers that qualify to avoid calls.
+TYPE_DISPATCHED_HANDLERS = set(
+    DEFAULT_GET_VALUE_HANDLERS + DEFAULT_SET_FIELD_HANDLERS)
+
+DEFAULT_UPDATE_FIELD_HANDLERS = {
+    _set_field_rw_boolean: _update_field_rw_boolean,
+    _set_field_rw_entity: _update_field_rw_entity,
+    _set_field_image: _update_field_image,
+    _set_field_multiline_string: _update_field_multiline_string,
+    _set_field_calculated: _update_field_calculated,
+    _set_field_rw_path: _update_field_rw_path,
+    _set_field_ro_boolean: _update_field_ro_boolean,
+    _set_field_generic_valid_values: _update_field_generic_valid_values,
+    _set_field_generic: _update_field_generic,
+    }
+
+
 optimize.bind_all(sys.modules[__name__])  # Last line of module.
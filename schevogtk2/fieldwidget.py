@@ -8,6 +8,7 @@ from schevo.lib import optimize
 
 from xml.sax.saxutils import escape
 import os
+import weakref
 
 if os.name == 'nt':
     import pywintypes
@@ -22,10 +23,18 @@ from schevo.label import label
 from schevo.base import Entity
 from schevo.constant import UNASSIGNED
 
+from schevogtk2 import choicecache
 from schevogtk2 import icon
+from schevogtk2 import labelcache
+from schevogtk2 import labelindex
 from schevogtk2.utils import gsignal, type_register
 
 
+# Map of database to a map of the allowed extent names of entity
+# fields to the entities most recently chosen for such fields.
+_recent_map = weakref.WeakKeyDictionary()
+
+
 class BooleanRadio(gtk.VBox):
 
     __gtype_name__ = 'BooleanRadio'
@@ -35,8 +44,10 @@ class BooleanRadio(gtk.VBox):
     def __init__(self, field):
         gtk.VBox.__init__(self)
         self._value = value = field.get()
-        button_1 = gtk.RadioButton(None, field.true_description)
-        button_2 = gtk.RadioButton(button_1, field.false_description)
+        button_1 = self._true_button = gtk.RadioButton(
+            None, field.true_description)
+        button_2 = self._false_button = gtk.RadioButton(
+            button_1, field.false_description)
         button_1.show()
         button_2.show()
         self.add(button_1)
@@ -59,6 +70,13 @@ class BooleanRadio(gtk.VBox):
     def get_value(self):
         return self._value
 
+    def set_value(self, value):
+        if value:
+            self._true_button.set_active(True)
+        else:
+            self._false_button.set_active(True)
+        self._value = value
+
 
 class EntityChooser(gtk.HBox):
 
@@ -141,7 +159,18 @@ class EntityChooser(gtk.HBox):
         return self._entity_combobox.get_selected()
 
     def select_item_by_data(self, data):
-        return self._entity_combobox.select_item_by_data(data)
+        result = self._entity_combobox.select_item_by_data(data)
+        self._reset_update_button_sensitivity()
+        self._reset_view_button_sensitivity()
+        return result
+
+    def set_field(self, field):
+        """Show `field`, a field of the same kind as the one shown,
+        with the same allowed extents."""
+        self.field = field
+        self._entity_combobox.set_field(field)
+        self._reset_update_button_sensitivity()
+        self._reset_view_button_sensitivity()
 
     def _on_create_button__clicked(self, widget):
         db = self.db
@@ -206,7 +235,10 @@ class BaseComboBox(gtk.ComboBoxEntry):
 
     def __init__(self):
         gtk.ComboBoxEntry.__init__(self)
-        self.model = gtk.ListStore(str, object)
+        self.model = None
+        # Index of the rows, rebuilt when first needed after the model
+        # changes.
+        self._index = None
         self._populate()
         self.set_model(self.model)
         self.set_row_separator_func(self.is_row_separator)
@@ -254,24 +286,54 @@ class BaseComboBox(gtk.ComboBoxEntry):
         return False
 
     def select_item_by_text(self, text):
-        for row in self.model:
-            if row[0] == text:
-                self._handling_changed = True
-                self.set_active_iter(row.iter)
-                self._handling_changed = False
-                return
-        # Not in the combo box, so select nothing
-        self.set_active(-1)
+        self._select_position(self._row_index().find_text(text))
 
     def select_item_by_data(self, data):
-        for row in self.model:
-            if row[1] == data:
-                self._handling_changed = True
-                self.set_active_iter(row.iter)
-                self._handling_changed = False
-                return
-        # Not in the combo box, so select nothing
-        self.set_active(-1)
+        self._select_position(self._row_index().find_data(data))
+
+    def _on_model__changed(self, model, *args):
+        self._index = None
+
+    def _row_index(self):
+        index = self._index
+        if index is None:
+            index = self._index = choicecache.RowIndex(self.model)
+        return index
+
+    def _show_model(self):
+        """Show the model set by `_populate` in place of the previous
+        one."""
+        self._handling_changed = True
+        try:
+            self.set_model(self.model)
+            self.completion.set_model(self.model)
+        finally:
+            self._handling_changed = False
+
+    def _set_choice_model(self, choice_model):
+        """List the rows of the shared `choice_model`."""
+        self.model = choice_model.model
+        self._index = choice_model.index
+
+    def _set_rows(self, rows):
+        """List the (text, data) pairs of `rows` in a model of this
+        combo box's own."""
+        self.model = model = gtk.ListStore(str, object)
+        for row in rows:
+            model.append(row)
+        self._index = None
+        for signal in ('row-changed', 'row-deleted', 'row-inserted',
+                       'rows-reordered'):
+            model.connect(signal, self._on_model__changed)
+
+    def _select_position(self, position):
+        if position is None:
+            # Not in the combo box, so select nothing
+            self.set_active(-1)
+        else:
+            self._handling_changed = True
+            self.set_active(position)
+            self._handling_changed = False
 
 ##     def _on_entry__activate(self, entry):
 ##         self.emit('activate')
@@ -293,21 +355,12 @@ class BaseComboBox(gtk.ComboBoxEntry):
             return
         if self.get_selected() is not None:
             return
-        # Get the full text of the Entry widget, and see if any
-        # strings in the model begin with that text.
+        # Get the full text of the Entry widget, and see if one and
+        # only one string in the model begins with that text.
         entry_text = entry.get_text()
-        entry_text_lower = entry_text.lower()
-        matching_rows = [
-            # row,
-            ]
-        for row in self.model:
-            row_text = row[0]
-            if isinstance(row_text, basestring):
-                if row[0].lower().startswith(entry_text_lower):
-                    matching_rows.append(row)
-        # If there is one and only one such string,
-        if len(matching_rows) == 1:
-            row = matching_rows[0]
+        position = self._row_index().find_only_prefix(entry_text.lower())
+        if position is not None:
+            row = self.model[position]
             # Stop the insert-text signal from further emission until
             # we're done. For some reason, storing the handler_id of
             # the connect_after call in __init__ does not work
@@ -336,33 +389,35 @@ class EntityComboBox(BaseComboBox):
 
     __gtype_name__ = 'EntityComboBox'
 
-    # Function to create a label for an entity. By default, just use
-    # the unicode representation of the entity.
-    entity_label = unicode
+    # Function to create a label for an entity. By default, use the
+    # unicode representation of the entity, cached until it changes.
+    entity_label = staticmethod(labelcache.entity_label)
 
     # True if the presence of a single valid_value should indicate
     # that the value of the widget should be set to that value.  False
     # if the current value should be presented.
     autoselect_single_valid_value = True
 
+    # Number of allowed entities above which only the preferred,
+    # recently chosen and current values are listed at first, and
+    # other entities are listed as the user types.
+    scalable_threshold = 1000
+
+    # Maximum number of entities listed as matching the typed text.
+    max_match_rows = 100
+
+    # Number of recently chosen entities to list.
+    recent_count = 10
+
     def __init__(self, db, field):
         self.db = db
         self.field = field
+        self._scalable = self._is_scalable()
+        self._match_count = 0
         BaseComboBox.__init__(self)
-        # Default to the field's current item.
-        value = field.get()
-        if self.autoselect_single_valid_value:
-            if field.valid_values is not None:
-                if len(field.valid_values) == 1:
-                    # If the field has exactly one valid value, choose that.
-                    value = iter(field.valid_values).next()
-            else:
-                if field.required and len(self.model) == 2:
-                    # If the field has exactly one available value, choose it.
-                    value = self.model[-1][-1]
-        self.select_item_by_data(value)
-        if value != field.get():
-            gobject.timeout_add(0, self.emit, 'value-changed')
+        self._select_field_value()
+        self.connect('value-changed', self._on__value_changed)
+        self._set_match_func()
 
     def cell_icon(self, layout, cell, model, row):
         entity = model[row][1]
@@ -376,7 +431,94 @@ class EntityComboBox(BaseComboBox):
             cell.set_property('pixbuf', pixbuf)
             cell.set_property('visible', True)
 
+    def select_item_by_data(self, data):
+        if (self._scalable and isinstance(data, Entity)
+            and self._row_index().find_data(data) is None
+            ):
+            # Entities are listed on demand, so list this one, ahead
+            # of the rows listed for the typed text.
+            model = self.model
+            model.insert(len(model) - self._match_count,
+                         (self._entity_text(data), data))
+        BaseComboBox.select_item_by_data(self, data)
+
+    def set_field(self, field):
+        """Show `field`, a field of the same kind as the one shown,
+        with the same allowed extents."""
+        self.field = field
+        self._scalable = self._is_scalable()
+        self._match_count = 0
+        self._populate()
+        self._show_model()
+        self._select_field_value()
+        self._set_match_func()
+
+    def _entity_text(self, entity):
+        if len(self.field.allow) > 1:
+            extent_text = label(entity.s.extent)
+            return u'%s :: %s' % (self.entity_label(entity), extent_text)
+        else:
+            return u'%s' % (self.entity_label(entity), )
+
+    def _is_scalable(self):
+        """Return True if there are too many allowed entities to list
+        them all."""
+        field = self.field
+        if field.valid_values is not None:
+            return False
+        db = self.db
+        total = 0
+        for extent_name in field.allow:
+            total += len(db.extent(extent_name))
+            if total > self.scalable_threshold:
+                return True
+        return False
+
+    def _on__value_changed(self, widget):
+        entity = self.get_selected()
+        if not isinstance(entity, Entity):
+            return
+        field_map = _recent_map.get(self.db)
+        if field_map is None:
+            field_map = _recent_map[self.db] = {}
+        key = tuple(sorted(self.field.allow))
+        recent = field_map.setdefault(key, [])
+        if entity in recent:
+            recent.remove(entity)
+        recent.insert(0, entity)
+        del recent[self.recent_count:]
+
+    def _on_completion__is_match(self, completion, key, iter):
+        model = self.model
+        text = model[iter][0]
+        if text is None:
+            return False
+        if model.get_path(iter)[0] >= len(model) - self._match_count:
+            # Listed because it matches the typed text.
+            return True
+        return text.decode('utf-8').lower().startswith(key.decode('utf-8'))
+
+    def _on_entry__changed(self, widget):
+        if self._scalable and not self._handling_changed:
+            self._handling_changed = True
+            try:
+                self._update_matches(self.entry.get_text())
+            finally:
+                self._handling_changed = False
+        BaseComboBox._on_entry__changed(self, widget)
+
+    def _on_label_index__complete(self, index):
+        # Show the matches that were not labelled yet when searched.
+        self._handling_changed = True
+        try:
+            self._update_matches(self.entry.get_text())
+        finally:
+            self._handling_changed = False
+
     def _populate(self):
+        if self._scalable:
+            self._populate_scalable()
+            return
         db = self.db
         field = self.field
         allow = field.allow
@@ -385,15 +527,25 @@ class EntityComboBox(BaseComboBox):
             allow_multiple = True
         else:
             allow_multiple = False
+        preferred_values = field.preferred_values or []
+        valid_values = field.valid_values
+        value = field.get()
+        if not preferred_values and valid_values is None:
+            # All allowed values, listed in a model shared by all
+            # combo boxes listing them.
+            choice_model = choicecache.get_cache(db).entity_model(
+                db, allow, entity_label, self.unassigned_label)
+            if value in choice_model:
+                self._set_choice_model(choice_model)
+                return
         items = []
-        values = []
+        values = set()
         # Unassigned.
         items.append((self.unassigned_label, UNASSIGNED))
-        values.append(UNASSIGNED)
+        values.add(UNASSIGNED)
         # Preferred values.
-        preferred_values = field.preferred_values or []
         if preferred_values:
-            values.extend(preferred_values)
+            values.update(preferred_values)
             more = []
             for entity in sorted(preferred_values):
                 if entity is UNASSIGNED:
@@ -407,12 +559,12 @@ class EntityComboBox(BaseComboBox):
             items.extend(more)
             # Row separator.
             items.append((None, None))
+        preferred_values = set(preferred_values)
         # Valid values.
         more = []
-        valid_values = field.valid_values
         if valid_values is not None:
             # Specific valid values.
-            values.extend(valid_values)
+            values.update(valid_values)
             for entity in sorted(valid_values):
                 if entity is UNASSIGNED:
                     continue
@@ -425,21 +577,19 @@ class EntityComboBox(BaseComboBox):
                     text = u'%s' % (entity_label(entity), )
                 more.append((text, entity))
         else:
-            # Other allowed values.
-            for extent_name in field.allow:
-                extent = db.extent(extent_name)
-                for entity in sorted(extent):
+            # Other allowed values, listed once for all combo boxes.
+            choices = choicecache.get_cache(db).entity_choices(
+                db, allow, entity_label)
+            if preferred_values:
+                for text, entity in choices:
                     if entity in preferred_values:
                         continue
-                    values.append(entity)
-                    if allow_multiple:
-                        extent_text = label(extent)
-                        text = u'%s :: %s' % (entity_label(entity), extent_text)
-                    else:
-                        text = u'%s' % (entity_label(entity), )
+                    values.add(entity)
                     more.append((text, entity))
+            else:
+                values.update([entity for text, entity in choices])
+                more.extend(choices)
         items.extend(more)
-        value = field.get()
         if value not in values:
             entity = value
             # Row separator.
@@ -451,11 +601,110 @@ class EntityComboBox(BaseComboBox):
             else:
                 text = u'%s' % (entity_label(entity), )
             items.append((text, entity))
-        # Update the model.
+        self._set_rows(items)
+
+    def _populate_scalable(self):
+        """List only the preferred, recently chosen and current
+        values.  Other entities are listed by _update_matches."""
+        field = self.field
+        entity_text = self._entity_text
+        items = []
+        values = set()
+        # Unassigned.
+        items.append((self.unassigned_label, UNASSIGNED))
+        values.add(UNASSIGNED)
+        # Preferred values.
+        preferred_values = field.preferred_values or []
+        if preferred_values:
+            for entity in sorted(preferred_values):
+                if entity not in values:
+                    values.add(entity)
+                    items.append((entity_text(entity), entity))
+            # Row separator.
+            items.append((None, None))
+        # Recently chosen values that still exist.
+        field_map = _recent_map.get(self.db, {})
+        recent = field_map.get(tuple(sorted(field.allow)), [])
+        more = [(entity_text(entity), entity) for entity in recent
+                if entity not in values and entity.s.exists]
+        if more:
+            values.update(entity for text, entity in more)
+            items.extend(more)
+            # Row separator.
+            items.append((None, None))
+        # Current value.
+        value = field.get()
+        if value not in values:
+            items.append((entity_text(value), value))
+        self._set_rows(items)
+        self._match_count = 0
+
+    def _select_field_value(self):
+        # Default to the field's current item.
+        field = self.field
+        value = field.get()
+        if self.autoselect_single_valid_value:
+            if field.valid_values is not None:
+                if len(field.valid_values) == 1:
+                    # If the field has exactly one valid value, choose that.
+                    value = iter(field.valid_values).next()
+            elif not self._scalable:
+                if field.required and len(self.model) == 2:
+                    # If the field has exactly one available value, choose it.
+                    value = self.model[-1][-1]
+        self.select_item_by_data(value)
+        if value != field.get():
+            gobject.timeout_add(0, self.emit, 'value-changed')
+
+    def _set_match_func(self):
+        if self._scalable:
+            # Entities matching the typed text other than by prefix
+            # must also be offered for completion.  Few rows are
+            # listed, so matching them in Python is cheap.
+            self.completion.set_match_func(self._on_completion__is_match)
+
+    def _update_matches(self, text):
+        """Replace the entities listed for the previously typed text
+        with up to `max_match_rows` entities whose labels best match
+        `text`."""
         model = self.model
-        model.clear()
-        for text, entity in items:
-            model.append((text, entity))
+        for i in xrange(self._match_count):
+            del model[len(model) - 1]
+        self._match_count = 0
+        if not text or text == self.unassigned_label:
+            return
+        # Only the labels of the entities are indexed.
+        if len(self.field.allow) > 1:
+            text = text.split(u' :: ', 1)[0]
+        db = self.db
+        limit = self.max_match_rows
+        field_map = _recent_map.get(db, {})
+        recent = field_map.get(tuple(sorted(self.field.allow)), [])
+        matches = []
+        for extent_name in self.field.allow:
+            extent = db.extent(extent_name)
+            index = labelindex.get_index(extent, self.entity_label)
+            recent_oids = [entity._oid for entity in recent
+                           if entity._extent.name == extent_name]
+            for score, label_text, oid in index.rank(
+                text, limit, recent_oids):
+                matches.append((-score, label_text, extent_name, oid))
+            if not index.complete:
+                index.build(self._on_label_index__complete)
+        # Best matches first.
+        matches.sort()
+        listed = set(row[1] for row in model)
+        rows = []
+        for score, label_text, extent_name, oid in matches[:limit]:
+            entity = db.extent(extent_name)[oid]
+            if entity not in listed:
+                rows.append((self._entity_text(entity), entity))
+        if rows:
+            # Row separator.
+            rows.insert(0, (None, None))
+            for row in rows:
+                model.append(row)
+            self._match_count = len(rows)
 
 type_register(EntityComboBox)
 
@@ -501,13 +750,13 @@ class ExtentComboBox(BaseComboBox):
 
     def _populate(self):
         db = self.db
-        model = self.model
-        model.clear()
-        model.append((self.unassigned_label, UNASSIGNED))
-        model.append((None, None))
+        items = []
+        items.append((self.unassigned_label, UNASSIGNED))
+        items.append((None, None))
         for extent_name in sorted(self.allowed_extents()):
             extent = db.extent(extent_name)
-            model.append((self.extent_label(extent), extent))
+            items.append((self.extent_label(extent), extent))
+        self._set_rows(items)
 
 type_register(ExtentComboBox)
 
@@ -652,6 +901,14 @@ class ValueChooser(gtk.HBox):
         """Return the currently selected Schevo object."""
         return self._value_combobox.get_selected()
 
+    def select_item_by_data(self, data):
+        return self._value_combobox.select_item_by_data(data)
+
+    def set_field(self, field):
+        """Show `field`, a field of the same kind as the one shown."""
+        self.field = field
+        self._value_combobox.set_field(field)
+
     def _on_value_changed(self, widget):
         self.emit('value-changed')
 
@@ -674,16 +931,33 @@ class ValueComboBox(BaseComboBox):
         cell.set_property('stock_size', gtk.ICON_SIZE_SMALL_TOOLBAR)
         cell.set_property('visible', False)
 
+    def set_field(self, field):
+        """Show the valid values and current value of `field`, a field
+        of the same kind as the one shown."""
+        self.field = field
+        self._populate()
+        self._show_model()
+        self.select_item_by_data(field.get())
+
     def _populate(self):
-        db = self.db
         field = self.field
+        preferred_values = field.preferred_values or []
+        valid_values = field.valid_values
+        value = field.get()
+        if not preferred_values:
+            # Valid values, listed in a model shared by all combo
+            # boxes listing them.
+            choice_model = choicecache.value_model(
+                valid_values, self.unassigned_label)
+            if value in choice_model:
+                self._set_choice_model(choice_model)
+                return
         items = []
         values = []
         # Unassigned.
         items.append((self.unassigned_label, UNASSIGNED))
         values.append(UNASSIGNED)
         # Preferred values.
-        preferred_values = field.preferred_values or []
         if preferred_values:
             values.extend(preferred_values)
             more = []
@@ -696,26 +970,26 @@ class ValueComboBox(BaseComboBox):
             items.append((None, None))
         # Valid values.
         more = []
-        valid_values = field.valid_values
         values.extend(valid_values)
-        for value in sorted(valid_values):
+        for text, value in choicecache.value_choices(valid_values):
             if value is UNASSIGNED:
                 continue
             if value in preferred_values:
                 continue
-            more.append((unicode(value), value))
+            more.append((text, value))
         items.extend(more)
         value = field.get()
-        if value not in values:
+        try:
+            missing = value not in set(values)
+        except TypeError:
+            # Unhashable values can only be compared.
+            missing = value not in values
+        if missing:
             # Row separator.
             items.append((None, None))
             # Invalid, but current value.
             items.append((unicode(value), value))
-        # Update the model.
-        model = self.model
-        model.clear()
-        for text, value in items:
-            model.append((text, value))
+        self._set_rows(items)
 
 type_register(ValueComboBox)
 
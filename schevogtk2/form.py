@@ -8,6 +8,9 @@ from __future__ import with_statement
 import sys
 from schevo.lib import optimize
 
+import time
+
+import gobject
 import gtk
 from gtk import gdk
 
@@ -16,14 +19,27 @@ from schevo.constant import UNASSIGNED
 from schevo.label import label
 
 from schevogtk2.action import get_method_action, get_view_action
+from schevogtk2 import choicecache
+from schevogtk2 import counts
 from schevogtk2.error import FriendlyErrorDialog
 from schevogtk2.field import FieldLabel, DynamicField
+from schevogtk2 import labelcache
+from schevogtk2 import labelindex
 from schevogtk2 import plugin
 from schevogtk2.utils import gsignal
 
 
 class FormBox(gtk.VBox):
 
+    # Number of fields shown at first whose widgets are created at
+    # once, or None to create all widgets at once.  Widgets of the
+    # other fields shown are created when the main loop is idle, and
+    # those of hidden fields when they are shown.
+    eager_fields = 20
+
+    # Seconds spent creating widgets in each idle callback.
+    frame_budget = 0.02
+
     def __init__(self):
         gtk.VBox.__init__(self)
         self.set_border_width(10)
@@ -33,22 +49,72 @@ class FormBox(gtk.VBox):
         self.header_sep = gtk.HSeparator()
         self.pack_start(self.header_sep, expand=False, fill=False, padding=0)
         self.table = None
+        # Fields shown in the table, and the field names and handlers
+        # that the table was laid out for.
+        self._fields = []
+        self._table_key = None
+        self._build_source = None
+        self.connect('destroy', self._on__destroy)
 
     def set_fields(self, db, fields, get_value_handlers, set_field_handlers):
-        if self.table is not None:
-            self.remove(self.table)
-        field_count = len(fields)
-        if field_count > 0:
-            self.table = get_table(
-                db, fields, get_value_handlers, set_field_handlers)
-            self.table.show()
-            self.pack_start(self.table, expand=True, fill=True, padding=0)
+        self._cancel_build()
+        table_key = (
+            tuple([field.name for field in fields]),
+            tuple(get_value_handlers),
+            tuple(set_field_handlers),
+            )
+        if self.table is not None and table_key == self._table_key:
+            # Show the fields in the widgets laid out for the previous
+            # fields of the same names.
+            rebind_table(db, self._fields, fields, self.eager_fields)
+        else:
+            if self.table is not None:
+                self.remove(self.table)
+                self.table = None
+            field_count = len(fields)
+            if field_count > 0:
+                self.table = get_table(
+                    db, fields, get_value_handlers, set_field_handlers,
+                    self.eager_fields)
+                self.table.show()
+                self.pack_start(
+                    self.table, expand=True, fill=True, padding=0)
+            self._table_key = table_key
+        self._fields = list(fields)
+        for field in fields:
+            if field.x.control_widget.deferred and not field.hidden:
+                self._build_source = gobject.idle_add(
+                    self._build_fields(db, fields).next)
+                break
 
     def set_header_text(self, text):
         self.header.set_text(text)
         self.header.show()
         self.header_sep.show()
 
+    def _build_fields(self, db, fields):
+        """Create the deferred widgets of the fields shown, from the
+        top of the form down."""
+        budget = self.frame_budget
+        deadline = time.time() + budget
+        for field in fields:
+            widget_box = field.x.control_widget
+            if widget_box.deferred and not field.hidden:
+                widget_box.set_field(db, field)
+                if time.time() >= deadline:
+                    yield True
+                    deadline = time.time() + budget
+        self._build_source = None
+        yield False
+
+    def _cancel_build(self):
+        if self._build_source is not None:
+            gobject.source_remove(self._build_source)
+            self._build_source = None
+
+    def _on__destroy(self, widget):
+        self._cancel_build()
+
 
 class FormBoxWithButtons(gtk.VBox):
 
@@ -57,10 +123,29 @@ class FormBoxWithButtons(gtk.VBox):
     gsignal('edit-clicked')
     gsignal('ok-clicked')
 
+    # Milliseconds without further changes to wait before re-rendering
+    # the fields affected by changed fields, so that a burst of
+    # changes, such as typing, causes a single re-render.
+    rerender_delay = 150
+
     def __init__(self):
         gtk.VBox.__init__(self)
         self.db = None
         self.model = None
+        # True while the model is being acted on, such as a transaction
+        # being executed; see `set_busy`.
+        self.busy = False
+        # Fields changed since the last re-render, and the (value,
+        # hidden) state of each field when it was last rendered.
+        self._changed_fields = []
+        self._field_states = {}
+        self._rerender_source = None
+        # Names of the required fields shown that are unassigned.
+        self._unassigned_required = set()
+        # (widget, handler id) pairs of the handlers connected to the
+        # widgets of the current fields.
+        self._change_handlers = []
+        self.connect('destroy', self._on__destroy)
         # self
         self.set_spacing(5)
         self.set_border_width(5)
@@ -73,6 +158,10 @@ class FormBoxWithButtons(gtk.VBox):
         footer_sep = gtk.HSeparator()
         footer_sep.show()
         self.pack_start(footer_sep, expand=False, fill=False, padding=0)
+        #   progress_bar, shown while busy
+        progress_bar = gtk.ProgressBar()
+        self.progress_bar = progress_bar
+        self.pack_start(progress_bar, expand=False, fill=True, padding=0)
         #   button_box
         button_box = gtk.HButtonBox()
         button_box.set_layout(gtk.BUTTONBOX_END)
@@ -100,12 +189,38 @@ class FormBoxWithButtons(gtk.VBox):
         button.connect('clicked', self.on_close_button__clicked)
         button_box.add(button)
 
+    def set_busy(self, busy, text=None):
+        """Show a progress bar, with `text` if given, and keep the
+        fields and buttons from being used while `busy` is True."""
+        self.busy = busy
+        self.form_box.set_sensitive(not busy)
+        self.cancel_button.set_sensitive(not busy)
+        progress_bar = self.progress_bar
+        if busy:
+            self.ok_button.set_sensitive(False)
+            progress_bar.set_text(text or '')
+            progress_bar.pulse()
+            progress_bar.show()
+        else:
+            progress_bar.hide()
+            self._update_ok_button()
+
     def set_db(self, db):
         self.db = db
 
     def set_fields(self, model, fields, get_value_handlers, set_field_handlers):
         db = self.db
         self.model = model
+        self._cancel_rerender()
+        for widget, handler_id in self._change_handlers:
+            widget.disconnect(handler_id)
+        self._change_handlers = []
+        self._changed_fields = []
+        self._field_states = dict(
+            (name, _field_state(model.f[name])) for name in model.f)
+        self._unassigned_required = set()
+        for name in model.f:
+            self._update_required(model.f[name])
         self.get_value_handlers = get_value_handlers
         self.set_field_handlers = set_field_handlers
         self.form_box.set_fields(
@@ -121,26 +236,24 @@ class FormBoxWithButtons(gtk.VBox):
                 # When converting from one type to another, bad input
                 # might generate an error. Ignore it here.
                 pass
-            for name in model.f:
-                field = model.f[name]
-                if field == changed_field:
-                    continue
-                # Hide or unhide.
-                field.x.label_widget.props.visible = not field.hidden
-                field.x.control_widget.props.visible = not field.hidden
-                # Re-render field.
-                field.x.control_widget.reset()
-                # Re-render label.
-                field.x.label_widget.reset()
+            if changed_field not in self._changed_fields:
+                self._changed_fields.append(changed_field)
+            self._update_required(changed_field)
             self._update_ok_button()
+            # Re-render once changes stop.
+            self._cancel_rerender()
+            self._rerender_source = gobject.timeout_add(
+                self.rerender_delay, self._on_rerender_timeout)
         for field in fields:
             widget = field.x.control_widget
             try:
                 # Prefer the 'value-changed' signal.
-                widget.connect('value-changed', on__changed, field)
+                handler_id = widget.connect(
+                    'value-changed', on__changed, field)
             except TypeError:
                 # Fall back to the 'changed' signal.
-                widget.connect('changed', on__changed, field)
+                handler_id = widget.connect('changed', on__changed, field)
+            self._change_handlers.append((widget, handler_id))
         if isinstance(model, schevo.base.Transaction):
             self.ok_button.show()
             self.cancel_button.show()
@@ -169,11 +282,65 @@ class FormBoxWithButtons(gtk.VBox):
         self.emit('edit-clicked')
 
     def on_ok_button__clicked(self, button):
+        if self.busy:
+            return
+        if self._rerender_source is not None:
+            # Apply pending changes, which may make the transaction
+            # unready for execution.
+            self._rerender()
+            if not button.props.sensitive:
+                return
         self.emit('ok-clicked')
 
+    def _cancel_rerender(self):
+        if self._rerender_source is not None:
+            gobject.source_remove(self._rerender_source)
+            self._rerender_source = None
+
+    def _on__destroy(self, widget):
+        self._cancel_rerender()
+
+    def _on_rerender_timeout(self):
+        self._rerender_source = None
+        self._rerender()
+        # Remove the timer.
+        return False
+
+    def _rerender(self):
+        """Re-render the fields, other than those changed by the user,
+        whose value, visibility or metadata changed since they were
+        last rendered."""
+        self._cancel_rerender()
+        changed_fields = self._changed_fields
+        self._changed_fields = []
+        states = self._field_states
+        f = self.model.f
+        for name in f:
+            field = f[name]
+            state = _field_state(field)
+            unchanged = (state == states.get(name)
+                         and not field.metadata_changed)
+            states[name] = state
+            if unchanged:
+                continue
+            self._update_required(field)
+            if field in changed_fields:
+                continue
+            # Hide or unhide.
+            field.x.label_widget.props.visible = not field.hidden
+            field.x.control_widget.props.visible = not field.hidden
+            # Re-render field.
+            field.x.control_widget.reset()
+            # Re-render label.
+            field.x.label_widget.reset()
+        self._update_ok_button()
+
     def _update_ok_button(self):
         button = self.ok_button
         model = self.model
+        if self.busy:
+            button.props.sensitive = False
+            return
         # First check for changed fields.
         if (isinstance(model, schevo.base.Transaction)
             and model.s.requires_changes
@@ -182,19 +349,29 @@ class FormBoxWithButtons(gtk.VBox):
             button.props.sensitive = False
             return
         # Check required fields.
-        f = model.f
-        for name in f:
-            field = f[name]
-            if (field.required
-                and not field.hidden
-                and field.value is UNASSIGNED
-                ):
-                button.props.sensitive = False
-                return
+        if self._unassigned_required:
+            button.props.sensitive = False
+            return
         # All required fields were assigned values, and the
         # transaction will allow execution attempt.
         button.props.sensitive = True
 
+    def _update_required(self, field):
+        """Record whether `field` is a required field shown that is
+        unassigned."""
+        if (field.required
+            and not field.hidden
+            and field.value is UNASSIGNED
+            ):
+            self._unassigned_required.add(field.name)
+        else:
+            self._unassigned_required.discard(field.name)
+
+
+def _field_state(field):
+    """Return the state of `field` that its widgets render."""
+    return (field.get(), field.hidden)
+
 
 class FormWindow(gtk.Window):
 
@@ -202,6 +379,12 @@ class FormWindow(gtk.Window):
         gtk.Window.__init__(self)
         self._bindings = {}
         self.tx_result = None
+        # Key of the kind of dialog this window is kept for by
+        # `dialog_pool` when released, or None.
+        self.pool_key = None
+        # (widget, handler id) pairs of the create, update and view
+        # handlers connected to the widgets of the current fields.
+        self._field_handlers = []
         self.set_default_size(400, -1)
         form_box = FormBoxWithButtons()
         self.form_box = form_box
@@ -212,6 +395,8 @@ class FormWindow(gtk.Window):
         form_box.show()
         self.add(form_box)
         self.connect('hide', self.quit)
+        self.connect('delete-event', self._on_delete_event)
+        self.connect('destroy', self._on_destroy)
         self.connect('key-press-event', self._on_key_press_event)
         self._set_bindings()
 
@@ -235,18 +420,30 @@ class FormWindow(gtk.Window):
             )
         dialog.run()
         tx_result = dialog.tx_result
-        dialog.destroy()
+        release_dialog(dialog)
         # Only update field widgets if what we're viewing was what was
         # updated.
         if tx_result == model:
+            fields = tx_result.s.field_map().values()
             self.set_fields(
                 tx_result,
-                tx_result.s.field_map().values(),
+                fields,
+                form_box.get_value_handlers,
+                form_box.set_field_handlers,
+                )
+            # The handlers attached for the previous fields act on
+            # them, so attach handlers for the new fields.
+            self.attach_field_handlers(
+                form_box.db,
+                fields,
                 form_box.get_value_handlers,
                 form_box.set_field_handlers,
                 )
 
     def on_form_box__ok_clicked(self, form_box):
+        if form_box.busy:
+            # Already executing.
+            return
         with FriendlyErrorDialog(self):
             tx = form_box.model
             for name in tx.f:
@@ -256,10 +453,54 @@ class FormWindow(gtk.Window):
                 widget = field.x.control_widget
                 value = widget.get_value()
                 setattr(tx, name, value)
-            self.tx_result = tx._db.execute(tx)
+            # Show that the transaction is executing, and keep it from
+            # being submitted again, before executing it.  Idle
+            # callbacks run after windows are redrawn.
+            form_box.set_busy(True, u'Executing %s...' % label(tx))
+            gobject.idle_add(self._on_execute_idle, tx)
+
+    def _on_delete_event(self, window, event):
+        # Hide rather than be destroyed, so that the window can be
+        # kept for reuse once released, but stay open until the
+        # transaction being executed finishes.
+        if not self.form_box.busy:
             self.hide()
+        return True
+
+    def _on_destroy(self, window):
+        # A destroyed window has lost its widgets, so must not be
+        # reused.
+        self.pool_key = None
+
+    def _on_execute_idle(self, tx):
+        # The database cannot be used by more than one thread, so the
+        # main loop waits while the transaction executes.
+        with FriendlyErrorDialog(self):
+            try:
+                tx_result = tx._db.execute(tx)
+            finally:
+                self.form_box.set_busy(False)
+            self._on_executed(tx_result)
+        # Remove the idle callback.
+        return False
+
+    def _on_executed(self, tx_result):
+        tx = self.form_box.model
+        self.tx_result = tx_result
+        # Transactions of nested dialogs change the database too, and
+        # entities they create must be listed by the combo boxes of
+        # the dialogs beneath them.
+        db = tx._db
+        choicecache.reflect_changes(db, tx)
+        counts.get_cache(db).reflect_changes(tx)
+        labelcache.reflect_changes(db, tx)
+        labelindex.reflect_changes(db, tx)
+        self.hide()
 
     def _on_key_press_event(self, window, event):
+        if self.form_box.busy:
+            # Stay open until the transaction being executed finishes.
+            return
         keyval = event.keyval
         mask = event.state & gdk.MODIFIER_MASK
         binding = (keyval, mask)
@@ -287,6 +528,17 @@ class FormWindow(gtk.Window):
             mod = mod | gtk.gdk.LOCK_MASK
             self._bindings[(keyval, mod)] = func
 
+    def attach_field_handlers(
+        self, db, fields, get_value_handlers, set_field_handlers):
+        """Attach create, update and view handlers to the widgets of
+        `fields`, detaching those attached for previous fields."""
+        for widget, handler_id in self._field_handlers:
+            widget.disconnect(handler_id)
+        self._field_handlers = []
+        for field in fields:
+            self._field_handlers.extend(attach_create_update_view_handlers(
+                self, db, field, get_value_handlers, set_field_handlers))
+
     def set_db(self, db):
         self.form_box.set_db(db)
 
@@ -298,6 +550,72 @@ class FormWindow(gtk.Window):
             model, fields, get_value_handlers, set_field_handlers)
 
 
+class DialogPool(object):
+    """Hidden form windows kept for showing other instances of the
+    same kind of dialog without laying out their fields again.
+
+    Windows are kept by database, model class and field names.
+    """
+
+    # Maximum number of hidden windows kept for each kind of dialog.
+    max_per_key = 2
+
+    # Maximum number of hidden windows kept in all.  The least
+    # recently released ones are destroyed first.
+    max_windows = 8
+
+    def __init__(self):
+        self._windows = {}
+        # (key, window) pairs of the kept windows, least recently
+        # released first.
+        self._order = []
+
+    def acquire(self, key):
+        """Return a hidden window kept for `key`, or None."""
+        windows = self._windows.get(key)
+        while windows:
+            window = windows.pop()
+            self._order.remove((key, window))
+            if not windows:
+                del self._windows[key]
+            if window.pool_key is not None:
+                return window
+        return None
+
+    def discard(self, db):
+        """Destroy the windows kept for dialogs of `db`."""
+        windows = self._windows
+        for key in windows.keys():
+            if key[0] is db:
+                for window in windows.pop(key):
+                    window.destroy()
+        self._order = [(key, window) for key, window in self._order
+                       if key[0] is not db]
+
+    def release(self, window):
+        """Keep the hidden `window` for reuse, or destroy it if enough
+        windows of its kind are kept."""
+        key = window.pool_key
+        windows = self._windows.setdefault(key, [])
+        if len(windows) >= self.max_per_key:
+            window.destroy()
+            return
+        window.tx_result = None
+        windows.append(window)
+        order = self._order
+        order.append((key, window))
+        while len(order) > self.max_windows:
+            key, window = order.pop(0)
+            windows = self._windows[key]
+            windows.remove(window)
+            if not windows:
+                del self._windows[key]
+            window.destroy()
+
+
+dialog_pool = DialogPool()
+
+
 class ExtentChoiceBox(gtk.VButtonBox):
 
     def __init__(self, allowed_extents):
@@ -408,7 +726,8 @@ def get_default_view_dialog(parent, db, entity, action,
                             get_value_handlers, set_field_handlers):
     extent_text = label(entity.s.extent)
     title = u'View :: %s' % (extent_text, )
-    text = u'View :: %s :: %s' % (extent_text, entity)
+    entity_text = labelcache.entity_label(entity)
+    text = u'View :: %s :: %s' % (extent_text, entity_text)
     def include(field):
         if action.include_expensive:
             return True
@@ -426,7 +745,7 @@ def attach_create_update_view_handlers(
     window, db, field, get_value_handlers, set_field_handlers,
     ):
     # Attach create-clicked, update-clicked and view-clicked handlers
-    # to each of its fields.
+    # to each of its fields, and return (widget, handler id) pairs.
     def on_create_clicked(dynamic_field, allowed_extents, done_cb=None):
         if len(allowed_extents) == 1:
             # If only one extent, simply use that extent.
@@ -456,7 +775,7 @@ def attach_create_update_view_handlers(
                 )
             dialog.run()
             tx_result = dialog.tx_result
-            dialog.destroy()
+            release_dialog(dialog)
             if tx_result is not None:
                 if done_cb is not None:
                     done_cb(tx_result)
@@ -477,7 +796,7 @@ def attach_create_update_view_handlers(
             )
         dialog.run()
         tx_result = dialog.tx_result
-        dialog.destroy()
+        release_dialog(dialog)
         if tx_result is not None:
             if done_cb is not None:
                 done_cb(tx_result)
@@ -496,30 +815,38 @@ def attach_create_update_view_handlers(
             set_field_handlers=set_field_handlers,
             )
         dialog.run()
-        dialog.destroy()
-    field.x.control_widget.connect('create-clicked', on_create_clicked)
-    field.x.control_widget.connect('update-clicked', on_update_clicked)
-    field.x.control_widget.connect('view-clicked', on_view_clicked)
+        release_dialog(dialog)
+    widget = field.x.control_widget
+    return [
+        (widget, widget.connect('create-clicked', on_create_clicked)),
+        (widget, widget.connect('update-clicked', on_update_clicked)),
+        (widget, widget.connect('view-clicked', on_view_clicked)),
+        ]
 
 def get_dialog(title, parent, text, db, model, fields,
                get_value_handlers, set_field_handlers):
-    # Create the form window and set its basic properties.
-    window = FormWindow()
-    window.set_db(db)
-    window.set_modal(True)
+    # Reuse a hidden form window laid out for the same kind of dialog,
+    # or create one and set its basic properties.
+    pool_key = (db, model.__class__, tuple([field.name for field in fields]))
+    window = dialog_pool.acquire(pool_key)
+    if window is None:
+        window = FormWindow()
+        window.pool_key = pool_key
+        window.set_db(db)
+        window.set_modal(True)
+        window.set_position(gtk.WIN_POS_CENTER_ON_PARENT)
     window.set_transient_for(parent)
-    window.set_position(gtk.WIN_POS_CENTER_ON_PARENT)
     window.set_title(title)
     window.set_header_text(text)
     # Populate its fields.
     window.set_fields(model, fields, get_value_handlers, set_field_handlers)
     # Attach handlers for entity fields.
-    for field in fields:
-        attach_create_update_view_handlers(
-            window, db, field, get_value_handlers, set_field_handlers)
+    window.attach_field_handlers(
+        db, fields, get_value_handlers, set_field_handlers)
     return window
 
-def get_table(db, fields, get_value_handlers, set_field_handlers):
+def get_table(db, fields, get_value_handlers, set_field_handlers,
+              eager_fields=None):
     """Return a gtk.Table widget containing labels and dynamic field widgets
     for each field given.
 
@@ -532,8 +859,13 @@ def get_table(db, fields, get_value_handlers, set_field_handlers):
 
     - `set_field_handlers`: A list of handlers to use when calling the
       `set_value` method of a `DynamicField` widget.
+
+    - `eager_fields`: Number of fields shown whose widgets are created
+      at once, or None for all.  The widgets of other fields are left
+      deferred; see `DynamicField.defer_field`.
     """
     field_count = len(fields)
+    eager_count = 0
     table = gtk.Table(rows=field_count, columns=2)
     table.set_row_spacings(5)
     table.set_col_spacings(5)
@@ -546,7 +878,11 @@ def get_table(db, fields, get_value_handlers, set_field_handlers):
             label_box.show()
         # Widget.
         widget_box = DynamicField(get_value_handlers, set_field_handlers)
-        widget_box.set_field(db, field)
+        if _create_now(field, eager_fields, eager_count):
+            widget_box.set_field(db, field)
+            eager_count += 1
+        else:
+            widget_box.defer_field(db, field)
         if not field.hidden:
             widget_box.show()
         # Attach to table.
@@ -563,6 +899,45 @@ def get_table(db, fields, get_value_handlers, set_field_handlers):
         row += 1
     return table
 
+def rebind_table(db, old_fields, fields, eager_fields=None):
+    """Show `fields` in the widgets of a table returned by `get_table`
+    for `old_fields`, which have the same names.
+
+    - `eager_fields`: As for `get_table`.
+    """
+    eager_count = 0
+    for old_field, field in zip(old_fields, fields):
+        label_box = old_field.x.label_widget
+        label_box.set_field(db, field)
+        label_box.props.visible = not field.hidden
+        widget_box = old_field.x.control_widget
+        if widget_box.rebind(db, field):
+            # Shown by the widget created for the old field.
+            pass
+        elif _create_now(field, eager_fields, eager_count):
+            widget_box.set_field(db, field)
+            eager_count += 1
+        else:
+            widget_box.defer_field(db, field)
+        widget_box.props.visible = not field.hidden
+        field.x.label_widget = label_box
+        field.x.control_widget = widget_box
+
+def _create_now(field, eager_fields, eager_count):
+    # Return True if the widget of `field` is to be created at once,
+    # given the number of widgets created at once so far.
+    if eager_fields is None:
+        return True
+    return not field.hidden and eager_count < eager_fields
+
+def release_dialog(dialog):
+    """Release a dialog returned by `get_tx_dialog` or
+    `get_view_dialog` once it is closed, instead of destroying it."""
+    if isinstance(dialog, FormWindow) and dialog.pool_key is not None:
+        dialog_pool.release(dialog)
+    else:
+        dialog.destroy()
+
 def get_tx_dialog(parent, db, tx, action,
                   get_value_handlers, set_field_handlers):
     WindowClass = plugin.get_custom_tx_dialog_class(db, action)
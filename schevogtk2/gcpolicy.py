@@ -0,0 +1,75 @@
+"""Garbage collection after widgets discard many objects."""
+
+# Copyright (c) 2001-2009 ElevenCraft Inc.
+# See LICENSE for details.
+
+import sys
+from schevo.lib import optimize
+
+import gc
+import time
+
+import gobject
+
+
+# Collection policies.
+IDLE = 'idle'              # Full collection once the main loop is idle.
+GENERATION = 'generation'  # Immediate collection of young generations.
+OFF = 'off'                # Leave collection to the interpreter.
+
+
+class Collector(object):
+    """Collects garbage according to `policy`, and records how long
+    collections take and how many unreachable objects they find.
+
+    A steadily growing `unreachable` count means that reference cycles
+    are being created; set `gc.DEBUG_SAVEALL` with `gc.set_debug` and
+    inspect `gc.garbage` to find them.
+    """
+
+    policy = IDLE
+
+    # Oldest generation collected by the GENERATION policy.
+    generation = 0
+
+    def __init__(self):
+        self.collections = 0
+        self.max_seconds = 0.0
+        self.seconds = 0.0
+        self.unreachable = 0
+        self._source = None
+
+    def collect(self):
+        """Collect garbage according to the current policy."""
+        policy = self.policy
+        if policy == IDLE:
+            # Any number of requests made before the main loop is
+            # idle again result in a single collection.
+            if self._source is None:
+                self._source = gobject.idle_add(
+                    self._on_idle, priority=gobject.PRIORITY_LOW)
+        elif policy == GENERATION:
+            self._collect(self.generation)
+        elif policy != OFF:
+            raise ValueError('%r value for policy is not valid.' % (policy))
+
+    def _collect(self, generation=2):
+        start = time.time()
+        unreachable = gc.collect(generation)
+        seconds = time.time() - start
+        self.collections += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.unreachable += unreachable
+
+    def _on_idle(self):
+        self._source = None
+        self._collect()
+        # Remove the idle callback.
+        return False
+
+
+collector = Collector()
+
+
+optimize.bind_all(sys.modules[__name__])  # Last line of module.
@@ -3,29 +3,37 @@
 # Copyright (c) 2001-2009 ElevenCraft Inc.
 # See LICENSE for details.
 
-import gc
 import datetime
 import sys
+import time
 from schevo.lib import optimize
 
+from itertools import izip
+
 from schevo.error import EntityDoesNotExist
 
+import gobject
 import gtk
 from gtk import gdk
 
+from schevogtk2 import counts
+from schevogtk2 import gcpolicy
+from schevogtk2 import imagecache
+from schevogtk2.labelcache import entity_label
+from schevogtk2.cache import LRUCache
+from schevogtk2.gridmodel import (
+    COLOR_COLUMN, OBJECT_COLUMN, STRIKETHROUGH_COLUMN, VirtualListModel)
 from schevogtk2.utils import gproperty, gsignal, type_register
 
 
 WATCH = gdk.Cursor(gdk.WATCH)
 
-OBJECT_COLUMN = 0
-COLOR_COLUMN = 1
-STRIKETHROUGH_COLUMN = 2
-
 
 class Column(object):
 
     get_attribute = getattr
+    # Height that images in 'pixbuf' columns are scaled down to.
+    image_height = 32
     justify = gtk.JUSTIFY_LEFT
     visible = True
     width = None
@@ -54,47 +62,32 @@ class Column(object):
             self.cell_prop = 'active'
 
     def cell_data(self, column, cell, model, row_iter):
-        instance = model[row_iter][OBJECT_COLUMN]
-        color = model[row_iter][COLOR_COLUMN]
-        limits = self.grid.limit_row_background_color
+        instance, color, strikethrough = model.get(
+            row_iter, OBJECT_COLUMN, COLOR_COLUMN, STRIKETHROUGH_COLUMN)
+        grid = self.grid
+        limits = grid.limit_row_background_color
         if limits is not None and self.attribute in limits:
             cell.set_property('cell-background', color)
-        strikethrough = model[row_iter][STRIKETHROUGH_COLUMN]
         try:
             cell.set_property('strikethrough', strikethrough)
         except TypeError:
             # Cell does not have the 'strikethrough' property.
             pass
-        try:
-            data = self.cell_data_getattr(instance, self.attribute)
-        except EntityDoesNotExist:
-            data = None
-        if self.call:
-            data = data()
         prop = self.cell_prop
-        if data is not None:
-            if prop == 'text':
-                try:
-                    data = unicode(data)
-                except EntityDoesNotExist:
-                    data = None
-            elif prop == 'pixbuf':
-                loader = gtk.gdk.PixbufLoader()
-                loader.write(data)
-                loader.close()
-                data = loader.get_pixbuf()
-            elif prop == 'active':
-                try:
-                    data = bool(data)
-                except EntityDoesNotExist:
-                    data = None
+        if instance is None:
+            # The entity of the row no longer exists.
+            data = None
+        elif prop == 'pixbuf':
+            # Images are kept in the image cache instead.
+            data = self.render_image(instance)
+        else:
+            data = grid.get_cell_value(self, instance)
         cell.set_property(prop, data)
 
     cell_data_getattr = staticmethod(getattr)
 
     def cell_icon(self, column, cell, model, row_iter):
-        instance = model[row_iter][OBJECT_COLUMN]
-        color = model[row_iter][COLOR_COLUMN]
+        instance, color = model.get(row_iter, OBJECT_COLUMN, COLOR_COLUMN)
         limits = self.grid.limit_row_background_color
         if limits is not None and self.attribute in limits:
             cell.set_property('cell-background', color)
@@ -132,6 +125,63 @@ class Column(object):
     def get_style(cls):
         return cls._style
 
+    def render(self, instance):
+        """Return the value of the cell property for `instance`."""
+        try:
+            data = self.cell_data_getattr(instance, self.attribute)
+        except EntityDoesNotExist:
+            data = None
+        if self.call:
+            data = data()
+        prop = self.cell_prop
+        if data is not None:
+            if prop == 'text':
+                try:
+                    data = entity_label(data)
+                except EntityDoesNotExist:
+                    data = None
+            elif prop == 'pixbuf':
+                loader = gtk.gdk.PixbufLoader()
+                loader.write(data)
+                loader.close()
+                data = loader.get_pixbuf()
+            elif prop == 'active':
+                try:
+                    data = bool(data)
+                except EntityDoesNotExist:
+                    data = None
+        return data
+
+    def render_image(self, instance):
+        """Return the cached thumbnail for `instance`, or a placeholder
+        while it is being decoded."""
+        height = self.image_height
+        key = imagecache.image_key(instance, self.attribute, height)
+        if key is None:
+            return self.render(instance)
+        def get_data():
+            try:
+                data = self.cell_data_getattr(instance, self.attribute)
+            except EntityDoesNotExist:
+                return None
+            if self.call:
+                data = data()
+            return data
+        return imagecache.cache.get(
+            key, get_data, height, self._on_image_decoded)
+
+    def sort_key(self, instance):
+        """Return the value to sort `instance` by in this column."""
+        value = self.get_attribute(instance, self.attribute)
+        if self.call:
+            value = value()
+        if isinstance(value, datetime.date):
+            value = value.timetuple()
+        return value
+
+    def _on_image_decoded(self, pixbuf):
+        self.grid._view.queue_draw()
+
     def _pack(self, column):
         """Pack one or more renderers into the column."""
         cell = self.cell
@@ -150,16 +200,70 @@ class Column(object):
         column.set_cell_data_func(cell, self.cell_data)
 
 
+class CountColumn(Column):
+    """Column showing the length of each row's instance, from the
+    count cache of its database, so that it is counted only once.
+
+    - `count_info`: Function returning the database of an instance
+      and its count cache key.
+    """
+
+    def __init__(self, grid, title, count_info):
+        Column.__init__(self, grid, '__len__', title, int, call=True)
+        self.count_info = count_info
+
+    def get_count(self, instance):
+        """Return the length of `instance`, or None until it is
+        counted."""
+        db, key = self.count_info(instance)
+        return counts.get_cache(db).get(
+            key, instance.__len__, self._on_counted)
+
+    def render(self, instance):
+        count = self.get_count(instance)
+        if count is not None:
+            count = unicode(count)
+        return count
+
+    def sort_key(self, instance):
+        return self.get_count(instance)
+
+    def _on_counted(self, count):
+        self.grid._view.queue_draw()
+
+
 class Grid(gtk.VBox):
 
     __gtype_name__ = 'Grid'
 
+    gsignal('population-progress', int, int)
+
     gsignal('row-activated', object)
 
     gsignal('selection-changed', object)
 
+    # Number of rows whose rendered cell values are cached.
+    cell_cache_size = 2000
+
+    # True if rows are kept in the order given by comparing their
+    # instances while no column is sorted.  Every row is resolved
+    # once when rows are set, and its instance kept for sorting.
+    default_sort = True
+
     limit_row_background_color = None
 
+    # True if set_row_keys adds the first rows at once and the rest
+    # from idle callbacks, emitting population-progress as it goes,
+    # so that the user need not wait for every row.
+    populate_incrementally = False
+
+    # Number of rows added at once when populating incrementally;
+    # about a screenful.
+    populate_first_rows = 100
+
+    # Seconds spent adding rows in each idle callback.
+    populate_frame_budget = 0.02
+
     search_equal_func = None
 
     def __init__(self, columns=[]):
@@ -183,13 +287,23 @@ class Grid(gtk.VBox):
         scrolled.show()
         self.pack_start(scrolled)
         self._bindings = {}
+        self._cell_cache = LRUCache(self.cell_cache_size)
         self._columns = []
         self._filter = None
+        self._population = None
+        self._population_source = None
+        # Map of identity to key of the rows that incremental
+        # population has yet to add.
+        self._pending_rows = {}
         self._sorter = None
         self._row_map = {}
         self._row_popup_menu = None
-        self._model = model = gtk.ListStore(object, object, object)
-        model.set_default_sort_func(model_default_sort)
+        self._sort_column = None
+        # Map of column, or of None for the default order, to a map of
+        # row key to that row's sort key.
+        self._sort_keys = {}
+        self._sort_order = gtk.SORT_ASCENDING
+        self._model = model = VirtualListModel(self._resolve_row)
         self._view = view = gtk.TreeView(model)
         view.connect(
             'button-press-event', self._on_view__button_press_event)
@@ -208,15 +322,65 @@ class Grid(gtk.VBox):
         self.set_selection_mode(gtk.SELECTION_BROWSE)
 
     def add_row(self, instance):
-        color = self.row_background_color(instance)
-        strikethrough = self.is_row_strikethrough(instance)
-        row_iter = self._model.append((instance, color, strikethrough))
-        return row_iter
+        return self._add_key(self.identify(instance),
+                             self.get_row_key(instance))
+
+    def cancel_population(self):
+        """Stop adding the rows that remain from incremental
+        population."""
+        source = self._population_source
+        if source is not None:
+            gobject.source_remove(source)
+            self._population = None
+            self._population_source = None
+        self._pending_rows.clear()
 
     def clear(self):
         """Removes all the instances of the list"""
+        self.cancel_population()
         self._model.clear()
         self._row_map.clear()
+        self._cell_cache.clear()
+        self._sort_keys.clear()
+
+    def get_cell_value(self, column, instance):
+        """Return the rendered value of `column` for `instance`, from
+        the cell cache if possible."""
+        revision = self.get_row_revision(instance)
+        if revision is None:
+            return column.render(instance)
+        inst_id, rev = revision
+        cache = self._cell_cache
+        entry = cache.get(inst_id)
+        if entry is None or entry[0] != rev:
+            entry = cache[inst_id] = (rev, {})
+        values = entry[1]
+        attribute = column.attribute
+        if attribute in values:
+            return values[attribute]
+        data = values[attribute] = column.render(instance)
+        return data
+
+    def get_row_instance(self, key):
+        """Return the instance for the model row `key`.
+
+        Overridden in subclasses that store something more compact
+        than the instance itself in the model.
+        """
+        return key
+
+    def get_row_key(self, instance):
+        """Return the model row key for `instance`."""
+        return instance
+
+    def get_row_revision(self, instance):
+        """Return an (identity, revision) tuple for `instance`, or None
+        if its rendered cell values must not be cached.
+
+        Overridden in subclasses whose instances carry a revision that
+        changes whenever their displayed values do.
+        """
+        return None
 
     def get_selected(self):
         """If in multiple selection mode, return a list of the
@@ -235,21 +399,34 @@ class Grid(gtk.VBox):
     def is_row_strikethrough(self, instance):
         return False
 
-    def redraw(self):
-        """Resets color and strikethrough values."""
-        model = self._model
-        for row in model:
-            instance = row[OBJECT_COLUMN]
-            try:
-                color = self.row_background_color(instance)
-            except EntityDoesNotExist:
-                color = None
-            row[COLOR_COLUMN] = color
-            try:
-                strikethrough = self.is_row_strikethrough(instance)
-            except EntityDoesNotExist:
-                strikethrough = False
-            row[STRIKETHROUGH_COLUMN] = strikethrough
+    def invalidate_row(self, inst_id):
+        """Forget cached values of the row whose instance has the
+        identity `inst_id`, and redraw it."""
+        self._cell_cache.pop(inst_id)
+        row_map = self._row_map
+        if inst_id in row_map:
+            key = row_map[inst_id]
+            for sort_keys in self._sort_keys.itervalues():
+                sort_keys.pop(key, None)
+            model = self._model
+            model.invalidate(key)
+            # Keep the row in sorted position.
+            sort_key = self._row_sort_key()
+            if sort_key is not None:
+                self._reposition(key, sort_key)
+
+    def redraw(self, instances=None):
+        """Resets color and strikethrough values of `instances`, or of
+        all rows if not given."""
+        if instances is None:
+            # Rendered cell values do not depend on color or
+            # strikethrough, so the cell cache is left alone.
+            self._model.invalidate()
+            self._view.queue_draw()
+        else:
+            identify = self.identify
+            for instance in instances:
+                self.invalidate_row(identify(instance))
 
     def refilter(self):
         if self._filter is not None:
@@ -259,13 +436,10 @@ class Grid(gtk.VBox):
         return None
 
     def select(self, instance, scroll=True):
-        model = self._model
-        view = self._view
-        selection = view.get_selection()
         inst_id = self.identify(instance)
-        row_iter = self._row_map[inst_id]
-        if row_iter in model:
-            selection.select_iter(row_iter)
+        row_iter = self._get_row_iter(inst_id)
+        if row_iter is not None:
+            self._view.get_selection().select_iter(row_iter)
             if scroll:
                 self.select_and_focus_row(row_iter)
 ##                 view.scroll_to_cell(model[row_iter].path, None, True, 0.5, 0)
@@ -275,12 +449,11 @@ class Grid(gtk.VBox):
 
     def set_columns(self, columns, spacer=True):
         # Reset sorting back to the default.
-        self._model.set_sort_column_id(-1, gtk.SORT_ASCENDING)
+        self._sort_column = None
+        self._sort_order = gtk.SORT_ASCENDING
+        self._sort_keys.clear()
         # Use a sort model if one was defined.
-        if self._sorter is not None:
-            model = self._sorter
-        else:
-            model = self._model
+        sorter = self._sorter
         view = self._view
         # Remove any existing columns.
         for column in view.get_columns():
@@ -288,9 +461,17 @@ class Grid(gtk.VBox):
         # Create new columns.
         self._columns = columns
         for index, column in enumerate(columns):
-            model.set_sort_func(index, model_sort, (column, column.attribute))
             view_column = column.create_column(self)
-            view_column.set_sort_column_id(index)
+            if sorter is not None:
+                sorter.set_sort_func(
+                    index, model_sort, (column, column.attribute))
+                view_column.set_sort_column_id(index)
+            else:
+                # The virtual model is not sortable by GTK itself, so
+                # sort it when the column header is clicked.
+                view_column.set_clickable(True)
+                view_column.connect(
+                    'clicked', self._on_view_column__clicked, column)
             view.append_column(view_column)
         # One additional column to take up any remaining space.
         if spacer:
@@ -298,6 +479,8 @@ class Grid(gtk.VBox):
             view_column.set_sizing(gtk.TREE_VIEW_COLUMN_FIXED)
             view_column.set_fixed_width(1)
             view.append_column(view_column)
+        if sorter is None:
+            self._sort_rows()
 
     def set_cursor(self, cursor=None):
         window = self.window
@@ -312,31 +495,71 @@ class Grid(gtk.VBox):
     identify = hash  # Overridden in subclasses.
 
     def set_rows(self, instances):
+        identify = self.identify
+        get_row_key = self.get_row_key
+        identities = []
+        keys = []
+        for instance in instances:
+            identities.append(identify(instance))
+            keys.append(get_row_key(instance))
+        self.set_row_keys(keys, identities)
+
+    def set_row_keys(self, keys, identities=None):
+        """Replace all rows with rows for the model keys `keys`,
+        without resolving their instances.
+
+        - `identities`: Sequence of the identities of the rows' instances;
+          the same as `keys` if not given.
+
+        If `populate_incrementally` is True, only the first rows are
+        added before returning.
+        """
+        self.cancel_population()
         self.set_cursor(WATCH)
         view = self._view
         view.freeze_notify()
         view.set_model(None)
         self.unselect_all()
-        self.clear()
-        gc.collect()
-        model = self._model
-        identify = self.identify
-        row_map = self._row_map
-        insert = model.insert
-        n = 0
-        for instance in instances:
-            inst_id = identify(instance)
-            color = self.row_background_color(instance)
-            strikethrough = self.is_row_strikethrough(instance)
-            row_iter = insert(n, (instance, color, strikethrough))
-            row_map[inst_id] = row_iter
-            n += 1
-        if self._sorter is not None:
-            view.set_model(self._sorter)
-        else:
-            view.set_model(model)
+        self._row_map.clear()
+        self._cell_cache.clear()
+        self._sort_keys.clear()
+        # Reclaim the discarded rows as the collection policy allows.
+        gcpolicy.collector.collect()
+        keys = list(keys)
+        if identities is None:
+            identities = keys
+        total = len(keys)
+        sort_key = self._row_sort_key()
+        if sort_key is not None:
+            # Sort all rows at once, so that the first rows added are
+            # the first ones in order and the rest follow them.
+            order = range(total)
+            order.sort(key=lambda position: sort_key(keys[position]),
+                       reverse=self._is_sort_reversed())
+            if identities is keys:
+                keys = identities = [keys[position] for position in order]
+            else:
+                identities = [identities[position] for position in order]
+                keys = [keys[position] for position in order]
+        first = self.populate_first_rows
+        remaining = None
+        if self.populate_incrementally and total > first:
+            remaining = zip(identities[first:], keys[first:])
+            identities = identities[:first]
+            keys = keys[:first]
+        self._row_map.update(izip(identities, keys))
+        # The view is detached, so only a filter needs to be told
+        # about each row.
+        self._model.set_keys(keys, notify=self._filter is not None)
+        self._attach_view()
         view.thaw_notify()
         self.set_cursor()
+        if remaining is not None:
+            self._pending_rows.update(remaining)
+            self.emit('population-progress', len(keys), total)
+            populate = self._population = self._populate(
+                remaining, len(keys), total)
+            self._population_source = gobject.idle_add(populate.next)
 
     def set_search_equal_func(self, search_equal_func):
         view = self._view
@@ -368,6 +591,222 @@ class Grid(gtk.VBox):
         if selection:
             selection.unselect_all()
 
+    def update_row_keys(self, removed, added):
+        """Remove the rows whose instances have the identities in
+        `removed`, and add rows for the (identity, key) pairs in
+        `added`, all at once with the view detached.
+
+        Unlike set_row_keys, cached values of the remaining rows are
+        kept.  The selection is cleared.
+        """
+        self.set_cursor(WATCH)
+        view = self._view
+        view.freeze_notify()
+        view.set_model(None)
+        self.unselect_all()
+        row_map = self._row_map
+        removed_keys = set()
+        for inst_id in removed:
+            key = row_map.pop(inst_id)
+            self._forget_row(inst_id, key)
+            removed_keys.add(key)
+        model = self._model
+        keys = [key for key in model.get_keys() if key not in removed_keys]
+        for inst_id, key in added:
+            row_map[inst_id] = key
+            keys.append(key)
+        sort_key = self._row_sort_key()
+        if sort_key is not None:
+            keys.sort(key=sort_key, reverse=self._is_sort_reversed())
+        model.set_keys(keys, notify=self._filter is not None)
+        self._attach_view()
+        view.thaw_notify()
+        self.set_cursor()
+
+    def _add_key(self, inst_id, key):
+        """Add a row for `key`, in sorted position, and return its iter."""
+        model = self._model
+        sort_key = self._row_sort_key()
+        if sort_key is None:
+            row_iter = model.append(key)
+        else:
+            row_iter = model.insert_sorted(
+                key, sort_key, self._is_sort_reversed())
+        self._row_map[inst_id] = key
+        return row_iter
+
+    def _attach_view(self):
+        """Show the model, through the sorter if there is one, in the
+        view."""
+        if self._sorter is not None:
+            self._view.set_model(self._sorter)
+        else:
+            self._view.set_model(self._model)
+
+    def _forget_row(self, inst_id, key):
+        """Drop cached values of a row that is being removed."""
+        self._cell_cache.pop(inst_id)
+        for sort_keys in self._sort_keys.itervalues():
+            sort_keys.pop(key, None)
+
+    def _get_row_iter(self, inst_id):
+        """Return the model iter of the row whose instance has the
+        identity `inst_id`, or None."""
+        row_map = self._row_map
+        if inst_id in row_map:
+            return self._model.get_iter_for_key(row_map[inst_id])
+
+    def _finish_population(self):
+        """Add the rows that remain from incremental population at the
+        end, in no particular order, so that all rows can be sorted
+        again."""
+        if self._population_source is None:
+            return
+        remaining = self._pending_rows.items()
+        self.cancel_population()
+        append = self._model.append
+        row_map = self._row_map
+        for inst_id, key in remaining:
+            if inst_id not in row_map:
+                row_map[inst_id] = key
+                append(key)
+        total = len(self._model)
+        self.emit('population-progress', total, total)
+
+    def _populate(self, rows, count, total):
+        """Add rows from `rows`, a list of (identity, key) pairs in
+        sorted order, yielding True whenever the frame budget is spent
+        and False once all rows are added.
+
+        Rows are sorted before population starts, and population is
+        finished at once when the sort order changes, so each row is
+        added after the rows added before it, without moving any.
+        """
+        add_key = self._add_key
+        pending = self._pending_rows
+        row_map = self._row_map
+        budget = self.populate_frame_budget
+        deadline = time.time() + budget
+        for inst_id, key in rows:
+            # The row may have been removed, or added, since population
+            # started.
+            if pending.pop(inst_id, None) is not None and (
+                inst_id not in row_map):
+                add_key(inst_id, key)
+            count += 1
+            if time.time() >= deadline:
+                self.emit('population-progress', count, total)
+                yield True
+                deadline = time.time() + budget
+        self._population = None
+        self._population_source = None
+        self.emit('population-progress', total, total)
+        yield False
+
+    def _reposition(self, key, sort_key):
+        """Move the row for `key` to its sorted position, keeping it
+        selected and under the cursor if it was."""
+        model = self._model
+        view = self._view
+        if view.get_model() is not model:
+            model.reposition(key, sort_key, self._is_sort_reversed())
+            return
+        selection = view.get_selection()
+        position = model.get_position(key)
+        selected = selection.path_is_selected((position, ))
+        cursor = view.get_cursor()[0]
+        has_cursor = cursor is not None and cursor[0] == position
+        # Moving the row unselects it for a moment; do not report that.
+        selection.handler_block_by_func(self._on_selection__changed)
+        try:
+            model.reposition(key, sort_key, self._is_sort_reversed())
+            path = (model.get_position(key), )
+            if has_cursor:
+                view.set_cursor(path)
+            if selected:
+                selection.select_path(path)
+        finally:
+            selection.handler_unblock_by_func(self._on_selection__changed)
+
+    def _resolve_row(self, key):
+        """Return the (instance, color, strikethrough) values of the
+        row for `key`."""
+        try:
+            instance = self.get_row_instance(key)
+        except EntityDoesNotExist:
+            return (None, None, False)
+        try:
+            color = self.row_background_color(instance)
+        except EntityDoesNotExist:
+            color = None
+        try:
+            strikethrough = self.is_row_strikethrough(instance)
+        except EntityDoesNotExist:
+            strikethrough = False
+        return (instance, color, strikethrough)
+
+    def _is_sort_reversed(self):
+        return self._sort_order == gtk.SORT_DESCENDING
+
+    def _row_sort_key(self):
+        """Return a function that gives the sort key of a row key
+        according to the current sort order, or None if rows are not
+        sorted.
+
+        Sort keys of a sorted column are computed once per row and
+        kept until the row changes, so that sorting and inserting
+        rows do not fetch attribute values again.
+        """
+        get_row_instance = self.get_row_instance
+        column = self._sort_column
+        if column is not None:
+            sort_keys = self._sort_keys.get(column)
+            if sort_keys is None:
+                sort_keys = self._sort_keys[column] = {}
+            column_sort_key = column.sort_key
+            def sort_key(key):
+                if key in sort_keys:
+                    return sort_keys[key]
+                try:
+                    value = column_sort_key(get_row_instance(key))
+                except EntityDoesNotExist:
+                    value = None
+                sort_keys[key] = value
+                return value
+        elif self.default_sort:
+            # Instances compare themselves; keep them so that they are
+            # resolved once per row.
+            sort_keys = self._sort_keys.get(None)
+            if sort_keys is None:
+                sort_keys = self._sort_keys[None] = {}
+            def sort_key(key):
+                if key in sort_keys:
+                    return sort_keys[key]
+                try:
+                    value = get_row_instance(key)
+                except EntityDoesNotExist:
+                    value = None
+                sort_keys[key] = value
+                return value
+        else:
+            return None
+        return sort_key
+
+    def _sort_rows(self):
+        """Reorder rows according to the current sort order."""
+        sort_key = self._row_sort_key()
+        if sort_key is None:
+            return
+        self.set_cursor(WATCH)
+        # Rows still to be added were sorted in the previous order, so
+        # add them now and sort them with the others.
+        self._finish_population()
+        model = self._model
+        keys = model.get_keys()
+        keys.sort(key=sort_key, reverse=self._is_sort_reversed())
+        model.reorder(keys)
+        self.set_cursor()
+
     # Event handlers ---------------------------------------------------------
 
     def _after_view__key_press_event(self, widget, event):
@@ -388,6 +827,21 @@ class Grid(gtk.VBox):
         item = self.get_selected()
         self.emit('selection-changed', item)
 
+    def _on_view_column__clicked(self, view_column, column):
+        if (self._sort_column is column
+            and self._sort_order == gtk.SORT_ASCENDING
+            ):
+            order = gtk.SORT_DESCENDING
+        else:
+            order = gtk.SORT_ASCENDING
+        for other in self._view.get_columns():
+            other.set_sort_indicator(False)
+        view_column.set_sort_order(order)
+        view_column.set_sort_indicator(True)
+        self._sort_column = column
+        self._sort_order = order
+        self._sort_rows()
+
     def _on_view__button_press_event(self, view, event):
         if self.get_selection_mode() == gtk.SELECTION_MULTIPLE:
             if event.button == 3 and self._row_popup_menu is not None:
@@ -466,22 +920,11 @@ class PopupMenu(gtk.Menu):
                 gtk.Menu.popup(self, None, None, None, event.button, event.time)
 
 
-def model_default_sort(model, row_iter1, row_iter2):
-    instance1 = model[row_iter1][OBJECT_COLUMN]
-    instance2 = model[row_iter2][OBJECT_COLUMN]
-    return cmp(instance1, instance2)
-
 def model_sort(model, row_iter1, row_iter2, (column, attr_name)):
     instance1 = model[row_iter1][OBJECT_COLUMN]
     instance2 = model[row_iter2][OBJECT_COLUMN]
-    get_attribute = column.get_attribute
-    attr1 = get_attribute(instance1, attr_name)
-    attr2 = get_attribute(instance2, attr_name)
-    if isinstance(attr1, datetime.date):
-        attr1 = attr1.timetuple()
-    if isinstance(attr2, datetime.date):
-        attr2 = attr2.timetuple()
-    return cmp((attr1, instance1), (attr2, instance2))
+    return cmp((column.sort_key(instance1), instance1),
+               (column.sort_key(instance2), instance2))
 
 
 optimize.bind_all(sys.modules[__name__])  # Last line of module.
@@ -0,0 +1,332 @@
+"""Virtual list model used by grid widgets."""
+
+# Copyright (c) 2001-2009 ElevenCraft Inc.
+# See LICENSE for details.
+
+import sys
+from schevo.lib import optimize
+
+from itertools import izip
+
+import gobject
+import gtk
+
+from schevogtk2.cache import LRUCache
+
+
+OBJECT_COLUMN = 0
+COLOR_COLUMN = 1
+STRIKETHROUGH_COLUMN = 2
+
+
+class VirtualListModel(gtk.GenericTreeModel):
+    """List-only tree model that stores one compact key per row.
+
+    Keys are typically entity OIDs.  The (instance, color,
+    strikethrough) values of a row are computed by calling
+    `resolve_row(key)` only when GTK asks for them, and only the most
+    recently used rows are kept, so memory grows with the number of
+    rows on screen rather than with the number of rows in the model.
+    """
+
+    column_types = (
+        gobject.TYPE_PYOBJECT,
+        gobject.TYPE_PYOBJECT,
+        gobject.TYPE_PYOBJECT,
+        )
+
+    # Number of resolved rows to keep; a few screenfuls.
+    cache_size = 512
+
+    def __init__(self, resolve_row):
+        gtk.GenericTreeModel.__init__(self)
+        # Keys are used directly as the user data of tree iters, and
+        # self._keys keeps them alive, so iters need not hold
+        # references of their own.
+        self.props.leak_references = False
+        self._resolve_row = resolve_row
+        self._keys = []
+        # Map of key to position.  Positions below self._valid_below
+        # are exact; rows from there on may have moved since their
+        # positions were recorded, and are brought up to date when
+        # next looked up.
+        self._positions = {}
+        self._valid_below = 0
+        self._rows = LRUCache(self.cache_size)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def append(self, key):
+        """Add a row for `key` to the end of the model and return its
+        iter."""
+        keys = self._keys
+        position = len(keys)
+        keys.append(key)
+        self._positions[key] = position
+        if self._valid_below == position:
+            self._valid_below = position + 1
+        return self._row_inserted(position)
+
+    def clear(self, notify=True):
+        """Remove all rows.
+
+        If `notify` is False, listeners are not told about each
+        removed row; only do this when no view is attached.
+        """
+        keys = self._keys
+        if notify:
+            positions = self._positions
+            row_deleted = self.row_deleted
+            while keys:
+                key = keys.pop()
+                del positions[key]
+                row_deleted((len(keys), ))
+        else:
+            self.invalidate_iters()
+        self._keys = []
+        self._positions = {}
+        self._valid_below = 0
+        self._rows.clear()
+
+    def contains_key(self, key):
+        return key in self._positions
+
+    def get_iter_for_key(self, key):
+        """Return an iter for the row of `key`, or None if there is no
+        such row."""
+        position = self._find_position(key)
+        if position is not None:
+            return self.create_tree_iter(self._keys[position])
+
+    def get_key(self, position):
+        return self._keys[position]
+
+    def get_keys(self):
+        """Return a list of the keys of all rows, in order."""
+        return self._keys[:]
+
+    def get_position(self, key):
+        position = self._find_position(key)
+        if position is None:
+            raise KeyError(key)
+        return position
+
+    def get_row(self, key):
+        """Return the (instance, color, strikethrough) tuple for the
+        row of `key`."""
+        rows = self._rows
+        row = rows.get(key)
+        if row is None:
+            row = rows[key] = self._resolve_row(key)
+        return row
+
+    def insert(self, position, key):
+        """Add a row for `key` at `position` and return its iter."""
+        keys = self._keys
+        if position >= len(keys):
+            return self.append(key)
+        keys.insert(position, key)
+        self._positions[key] = position
+        self._moved_from(position)
+        return self._row_inserted(position)
+
+    def insert_sorted(self, key, sort_key, reverse=False):
+        """Add a row for `key` at the position given by `sort_key`, a
+        function returning the sort key of a row key, and return its
+        iter."""
+        position = bisect_keys(self._keys, key, sort_key, reverse)
+        return self.insert(position, key)
+
+    def invalidate(self, key=None):
+        """Forget resolved values for the row of `key`, or for all rows
+        if `key` is None, so that they are resolved again when next
+        needed.
+
+        Listeners are told that the row of `key` changed; when
+        invalidating all rows, the caller must redraw the view.
+        """
+        if key is None:
+            self._rows.clear()
+        else:
+            self._rows.pop(key)
+            position = self._find_position(key)
+            if position is not None:
+                row_iter = self.create_tree_iter(self._keys[position])
+                self.row_changed((position, ), row_iter)
+
+    def remove(self, row_iter):
+        self.remove_key(self.get_user_data(row_iter))
+
+    def remove_key(self, key):
+        """Remove the row for `key`."""
+        self._remove_at(self.get_position(key))
+
+    def remove_keys(self, keys):
+        """Remove the rows for `keys`.
+
+        Rows are removed from the last one up, so that the positions
+        of the remaining ones are looked up without being updated
+        after each removal.
+        """
+        get_position = self.get_position
+        positions = [get_position(key) for key in keys]
+        positions.sort(reverse=True)
+        remove_at = self._remove_at
+        for position in positions:
+            remove_at(position)
+
+    def reorder(self, new_keys):
+        """Reorder rows to match `new_keys`, a permutation of the
+        current keys."""
+        get_position = self.get_position
+        new_order = [get_position(key) for key in new_keys]
+        old_keys = self._keys
+        # Keep the original key objects, since iters refer to them.
+        self._keys = [old_keys[position] for position in new_order]
+        self._moved_from(0)
+        if new_order:
+            self.rows_reordered(None, None, new_order)
+
+    def reposition(self, key, sort_key, reverse=False):
+        """Move the row for `key` to the position given by `sort_key`,
+        after its sort key has changed.
+
+        Listeners are told that the row was deleted and inserted
+        again, rather than that all rows were reordered, so the caller
+        must restore the selection of a moved row.
+        """
+        keys = self._keys
+        old_position = self.get_position(key)
+        # Keep the original key object, since iters refer to it.
+        key = keys.pop(old_position)
+        position = bisect_keys(keys, key, sort_key, reverse)
+        keys.insert(old_position, key)
+        if position != old_position:
+            self._remove_at(old_position)
+            self.insert(position, key)
+
+    def set_keys(self, keys, notify=True):
+        """Replace all rows with rows for `keys`.
+
+        If `notify` is False, listeners are not told about each
+        removed or inserted row; only do this when no view is attached.
+        """
+        self.clear(notify)
+        self._keys = keys = list(keys)
+        self._positions = dict(izip(keys, xrange(len(keys))))
+        self._valid_below = len(keys)
+        if notify:
+            create_tree_iter = self.create_tree_iter
+            row_inserted = self.row_inserted
+            for position, key in enumerate(keys):
+                row_inserted((position, ), create_tree_iter(key))
+
+    def _find_position(self, key):
+        """Return the position of the row for `key`, or None if there
+        is no such row."""
+        positions = self._positions
+        position = positions.get(key)
+        if position is None or position < self._valid_below:
+            return position
+        keys = self._keys
+        if position < len(keys) and keys[position] == key:
+            return position
+        # The row has moved; update the positions of all rows that
+        # may have moved, once for all of them.
+        for position in xrange(self._valid_below, len(keys)):
+            positions[keys[position]] = position
+        self._valid_below = len(keys)
+        return positions[key]
+
+    def _moved_from(self, position):
+        """Note that rows from `position` on may have moved."""
+        if position < self._valid_below:
+            self._valid_below = position
+
+    def _remove_at(self, position):
+        keys = self._keys
+        key = keys.pop(position)
+        del self._positions[key]
+        self._moved_from(position)
+        self._rows.pop(key)
+        self.row_deleted((position, ))
+
+    def _row_inserted(self, position):
+        row_iter = self.create_tree_iter(self._keys[position])
+        self.row_inserted((position, ), row_iter)
+        return row_iter
+
+    # GenericTreeModel implementation ----------------------------------------
+
+    def on_get_flags(self):
+        return gtk.TREE_MODEL_LIST_ONLY | gtk.TREE_MODEL_ITERS_PERSIST
+
+    def on_get_n_columns(self):
+        return len(self.column_types)
+
+    def on_get_column_type(self, index):
+        return self.column_types[index]
+
+    def on_get_iter(self, path):
+        position = path[0]
+        keys = self._keys
+        if position < len(keys):
+            return keys[position]
+
+    def on_get_path(self, rowref):
+        return (self._find_position(rowref), )
+
+    def on_get_value(self, rowref, column):
+        return self.get_row(rowref)[column]
+
+    def on_iter_next(self, rowref):
+        position = self._find_position(rowref)
+        if position is not None:
+            position += 1
+            keys = self._keys
+            if position < len(keys):
+                return keys[position]
+
+    def on_iter_children(self, parent):
+        keys = self._keys
+        if parent is None and keys:
+            return keys[0]
+
+    def on_iter_has_child(self, rowref):
+        return False
+
+    def on_iter_n_children(self, rowref):
+        if rowref is None:
+            return len(self._keys)
+        return 0
+
+    def on_iter_nth_child(self, parent, n):
+        keys = self._keys
+        if parent is None and n < len(keys):
+            return keys[n]
+
+    def on_iter_parent(self, child):
+        return None
+
+
+def bisect_keys(keys, key, sort_key, reverse=False):
+    """Return the position at which to insert `key` into `keys`, which
+    are sorted by `sort_key`, descending if `reverse` is True."""
+    value = sort_key(key)
+    low, high = 0, len(keys)
+    while low < high:
+        middle = (low + high) // 2
+        other = sort_key(keys[middle])
+        if reverse:
+            before = other < value
+        else:
+            before = value < other
+        if before:
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+
+optimize.bind_all(sys.modules[__name__])  # Last line of module.
@@ -6,16 +6,40 @@
 import sys
 from schevo.lib import optimize
 
+import time
 import weakref
 
+import gobject
 import gtk
 
 from schevo.base import Database
 from schevo.base import Extent
 
+from schevogtk2.background import Worker
+from schevogtk2.iconcache import DiskIconCache, data_digest, filename_for
+from schevogtk2.imagecache import decode
+
 
 _db_map = weakref.WeakKeyDictionary()
 
+# Map of database to a map of icon name to decoded pixbuf, or to None
+# if the database has no icon of that name.
+_decoded_map = weakref.WeakKeyDictionary()
+
+# Map of database to the `DiskIconCache` its icons were loaded from.
+_disk_map = weakref.WeakKeyDictionary()
+
+# Map of database to a map of (name, size, style) to rendered pixbuf.
+_pixbuf_map = weakref.WeakKeyDictionary()
+
+# Widgets whose style-set signal is connected to _on_style_set.
+_watched_widgets = weakref.WeakKeyDictionary()
+
+
+# Name of the extent in which schevo.icon keeps the icons of a
+# database.
+ICON_EXTENT = 'SchevoIcon'
+
 
 _stock_map = {
     'db.execute': gtk.STOCK_EXECUTE,
@@ -29,22 +53,24 @@ _stock_map = {
 
 def iconset(widget, *args):
     """Return a gtk.IconSet for the database object `obj`."""
-    # Find database from obj.
-    if isinstance(args[0], Database):
-        db, name = args
-    elif isinstance(args[0], Extent):
-        extent = args[0]
-        db = extent.db
-        name = u'db.%s' % extent.name
-    else:
-        # Could not find object.
-        return gtk.IconSet()
-    # Make sure database supports icons.
-    if not hasattr(db, '_icon'):
+    db, name = _db_and_name(args)
+    if db is None:
         return gtk.IconSet()
     return _iconset(widget, db, name)
 
 
+def icon_names(db):
+    """Return the names of the icons that `db` may show."""
+    names = set()
+    for extent in db.extents():
+        names.add(u'db.%s' % extent.name)
+        for q_name in extent.q:
+            names.add(u'q.%s' % q_name)
+        for t_name in extent.t:
+            names.add(u't.%s' % t_name)
+    return sorted(names)
+
+
 def large_image(widget, *args):
     """Return a large-size gtk.Image for the object."""
     iset = iconset(widget, *args)
@@ -59,28 +85,31 @@ def small_image(widget, *args):
 
 def large_pixbuf(widget, *args):
     """Return a large-size Pixbuf for the object."""
-    iset = iconset(widget, *args)
-    return iset.render_icon(
-        style=widget.get_style(),
-        direction=gtk.TEXT_DIR_NONE,
-        state=gtk.STATE_NORMAL,
-        size=gtk.ICON_SIZE_LARGE_TOOLBAR,
-        widget=None,
-        detail=None,
-        )
+    return _pixbuf(widget, gtk.ICON_SIZE_LARGE_TOOLBAR, args)
 
 
 def small_pixbuf(widget, *args):
     """Return a small-size Pixbuf for the object."""
-    iset = iconset(widget, *args)
-    return iset.render_icon(
-        style=widget.get_style(),
-        direction=gtk.TEXT_DIR_NONE,
-        state=gtk.STATE_NORMAL,
-        size=gtk.ICON_SIZE_SMALL_TOOLBAR,
-        widget=None,
-        detail=None,
-        )
+    return _pixbuf(widget, gtk.ICON_SIZE_SMALL_TOOLBAR, args)
+
+
+def _db_and_name(args):
+    """Return the database and icon name for `args`, or (None, None) if
+    there is no database that supports icons."""
+    # Find database from obj.
+    if isinstance(args[0], Database):
+        db, name = args
+    elif isinstance(args[0], Extent):
+        extent = args[0]
+        db = extent.db
+        name = u'db.%s' % extent.name
+    else:
+        # Could not find object.
+        return None, None
+    # Make sure database supports icons.
+    if not hasattr(db, '_icon'):
+        return None, None
+    return db, name
 
 
 def _iconset(widget, db, name):
@@ -92,21 +121,243 @@ def _iconset(widget, db, name):
     if (style, name) in name_iconset:
         return name_iconset[(style, name)]
     else:
-        data = db._icon(name, use_default=False)
-        if data is None:
+        decoded = _decoded_map.setdefault(db, {})
+        if name in decoded:
+            pixbuf = decoded[name]
+        else:
+            pixbuf = None
+            disk_cache = _disk_map.get(db)
+            if disk_cache is not None:
+                pixbuf = disk_cache.pixbuf(name)
+            if pixbuf is None:
+                data = db._icon(name, use_default=False)
+                if data is not None:
+                    pixbuf = decode(data)
+            decoded[name] = pixbuf
+        if pixbuf is None:
             if name in _stock_map:
                 stock_id = _stock_map[name]
             else:
                 stock_id = gtk.STOCK_FILE
             iset = style.lookup_icon_set(stock_id)
         else:
-            loader = gtk.gdk.PixbufLoader()
-            loader.write(data)
-            loader.close()
-            pixbuf = loader.get_pixbuf()
             iset = gtk.IconSet(pixbuf)
         name_iconset[(style, name)] = iset
         return iset
 
 
+class WarmUp(object):
+    """Fetches the icons of a database from idle callbacks, and decodes
+    them in a worker thread, so that they are ready to be drawn.
+
+    - `disk_cache`: `DiskIconCache` to take decoded icons from, and to
+      save them to once all are checked, or None.  Icons kept in it
+      are checked against the revision of their entity where the
+      database tells it, without reading their data, and replaced if
+      they have changed since.
+    """
+
+    # Seconds spent fetching icons in each idle callback.
+    frame_budget = 0.01
+
+    # Directory in which `warm_up` keeps decoded icons between
+    # sessions, or None to decode them again in each session.
+    disk_cache_dir = None
+
+    _worker = Worker('icon')
+
+    def __init__(self, db, names, disk_cache=None):
+        self.db = db
+        self.cancelled = False
+        self._names = list(names)
+        self._jobs = []
+        self._pending = 0
+        self._disk_cache = disk_cache
+        # Maps of icon name to stamp for icons kept in the disk cache,
+        # and to (stamp, pixbuf) for icons to save to it, where a
+        # pixbuf of None keeps the pixels already in the file.
+        self._loaded = {}
+        self._icons = {}
+        self._changed = False
+        if disk_cache is not None:
+            self._loaded = disk_cache.load()
+            _disk_map[db] = disk_cache
+        gobject.idle_add(self._on_idle, priority=gobject.PRIORITY_LOW)
+
+    def cancel(self):
+        """Stop fetching and decoding icons."""
+        self.cancelled = True
+        for job in self._jobs:
+            job.cancel()
+
+    def _finish(self):
+        disk_cache = self._disk_cache
+        if (disk_cache is None
+            or self._names
+            or self._pending
+            or (not self._changed
+                and len(self._icons) == len(self._loaded))
+            ):
+            return
+        try:
+            disk_cache.save(self._icons)
+        except EnvironmentError:
+            # The disk cache only saves time; do without it.
+            pass
+
+    def _on_idle(self):
+        if self.cancelled:
+            return False
+        db = self.db
+        decoded = _decoded_map.setdefault(db, {})
+        use_disk_cache = self._disk_cache is not None
+        loaded = self._loaded
+        names = self._names
+        deadline = time.time() + self.frame_budget
+        while names and time.time() < deadline:
+            name = names.pop()
+            if name in decoded and not use_disk_cache:
+                continue
+            stamp = None
+            if use_disk_cache:
+                stamp = _icon_stamp(db, name)
+                if stamp is not None and loaded.get(name) == stamp:
+                    self._icons[name] = (stamp, None)
+                    continue
+            data = db._icon(name, use_default=False)
+            if data is None:
+                if name in loaded:
+                    self._changed = True
+                    _replace_decoded(db, name, None)
+                else:
+                    decoded[name] = None
+                continue
+            if use_disk_cache and stamp is None:
+                # Without a revision to go by, tell changed icons by
+                # their data.
+                stamp = data_digest(data)
+                if loaded.get(name) == stamp:
+                    self._icons[name] = (stamp, None)
+                    continue
+            def publish(pixbuf, name=name, stamp=stamp):
+                self._publish(name, stamp, pixbuf)
+            job = self._worker.submit(
+                decode, (data, ), publish, self._on_decode_error)
+            self._jobs.append(job)
+            self._pending += 1
+        if names:
+            # Keep the idle callback while there are icons to fetch.
+            return True
+        self._finish()
+        return False
+
+    def _on_decode_error(self, exc_type, exc_val, exc_tb):
+        # Leave the icon to be decoded, and the error raised, when it
+        # is first drawn.
+        self._pending -= 1
+        self._finish()
+
+    def _publish(self, name, stamp, pixbuf):
+        self._pending -= 1
+        self._changed = True
+        if name in self._loaded:
+            # Replace the out of date icon loaded from the disk cache.
+            _replace_decoded(self.db, name, pixbuf)
+        else:
+            # Keep any icon decoded in the meantime.
+            _decoded_map.setdefault(self.db, {}).setdefault(name, pixbuf)
+        if stamp is not None:
+            self._icons[name] = (stamp, pixbuf)
+        self._finish()
+
+
+def warm_up(db, identity=None):
+    """Fetch and decode all icons of `db` in the background, and return
+    the `WarmUp` doing so, or None if `db` has no icons.
+
+    If `WarmUp.disk_cache_dir` is set, decoded icons are also kept on disk
+    between sessions for the database identified by the string
+    `identity`, such as its file name.
+    """
+    if not hasattr(db, '_icon'):
+        return None
+    disk_cache = None
+    directory = WarmUp.disk_cache_dir
+    if directory is not None and identity is not None:
+        disk_cache = DiskIconCache(filename_for(directory, identity))
+    return WarmUp(db, icon_names(db), disk_cache)
+
+
+def _icon_stamp(db, name):
+    """Return the (oid, revision) of the entity holding icon `name` of
+    `db`, without reading the icon's data, or None if it cannot be
+    told."""
+    if ICON_EXTENT not in db.extent_names():
+        return None
+    entity = db.extent(ICON_EXTENT).findone(name=name)
+    if entity is None:
+        return None
+    return (entity._oid, entity._rev)
+
+
+def _on_style_set(widget, previous_style):
+    """Forget icons rendered for the previous style of `widget`."""
+    if previous_style is None:
+        return
+    for name_iconset in _db_map.values():
+        for key in name_iconset.keys():
+            if key[0] is previous_style:
+                del name_iconset[key]
+    for pixbufs in _pixbuf_map.values():
+        for key in pixbufs.keys():
+            if key[2] is previous_style:
+                del pixbufs[key]
+
+
+def _replace_decoded(db, name, pixbuf):
+    """Replace the decoded icon `name` of `db` and forget what was made
+    from the icon it replaces."""
+    _decoded_map.setdefault(db, {})[name] = pixbuf
+    name_iconset = _db_map.get(db, {})
+    for key in name_iconset.keys():
+        if key[1] == name:
+            del name_iconset[key]
+    pixbufs = _pixbuf_map.get(db, {})
+    for key in pixbufs.keys():
+        if key[0] == name:
+            del pixbufs[key]
+
+
+def _pixbuf(widget, size, args):
+    """Return a Pixbuf of `size` for the object, rendering it only if
+    it is not cached."""
+    db, name = _db_and_name(args)
+    style = widget.get_style()
+    if db is None:
+        return _render(gtk.IconSet(), style, size)
+    pixbufs = _pixbuf_map.get(db)
+    if pixbufs is None:
+        pixbufs = _pixbuf_map[db] = {}
+    key = (name, size, style)
+    pixbuf = pixbufs.get(key)
+    if pixbuf is None:
+        if isinstance(widget, gtk.Widget) and widget not in _watched_widgets:
+            widget.connect('style-set', _on_style_set)
+            _watched_widgets[widget] = True
+        iset = _iconset(widget, db, name)
+        pixbuf = pixbufs[key] = _render(iset, style, size)
+    return pixbuf
+
+
+def _render(iset, style, size):
+    return iset.render_icon(
+        style=style,
+        direction=gtk.TEXT_DIR_NONE,
+        state=gtk.STATE_NORMAL,
+        size=size,
+        widget=None,
+        detail=None,
+        )
+
+
 optimize.bind_all(sys.modules[__name__])  # Last line of module.
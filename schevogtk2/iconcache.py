@@ -0,0 +1,182 @@
+"""On-disk cache of decoded icon images."""
+
+# Copyright (c) 2001-2009 ElevenCraft Inc.
+# See LICENSE for details.
+
+import sys
+from schevo.lib import optimize
+
+from hashlib import md5
+import marshal
+import mmap
+import os
+import struct
+
+import gtk
+
+
+MAGIC = 'SGTKICO1'
+
+# Format of the header that follows the magic string: the length of
+# the marshalled index.
+HEADER = '<I'
+
+
+class DiskIconCache(object):
+    """File holding the raw pixels of decoded icons, with a stamp that
+    tells which version of each icon they were decoded from.
+
+    The file starts with an index mapping icon names to (stamp,
+    has_alpha, width, height, rowstride, offset, length) tuples,
+    followed by the pixel data.  Once loaded, the file stays mapped
+    into memory, and the pixels of an icon are only copied into a
+    pixbuf when that icon is asked for.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._data = None
+        self._index = {}
+
+    def close(self):
+        """Unmap the file."""
+        data = self._data
+        if data is not None:
+            self._data = None
+            data.close()
+        self._index = {}
+
+    def load(self):
+        """Map the file and return a dictionary of icon name to stamp,
+        empty if the file does not exist or is not a valid cache."""
+        self.close()
+        try:
+            f = open(self.filename, 'rb')
+        except IOError:
+            return {}
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return {}
+            try:
+                data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            except EnvironmentError:
+                return {}
+        finally:
+            # The mapping stays valid once the file is closed.
+            f.close()
+        index = _read_index(data)
+        if index is None:
+            data.close()
+            return {}
+        self._data = data
+        self._index = index
+        return dict([(name, entry[0]) for name, entry in index.iteritems()])
+
+    def pixbuf(self, name):
+        """Return a pixbuf of the pixels kept for icon `name`, or None
+        if there are none."""
+        entry = self._index.get(name)
+        if entry is None:
+            return None
+        stamp, has_alpha, width, height, rowstride, offset, length = entry
+        try:
+            return gtk.gdk.pixbuf_new_from_data(
+                self._data[offset:offset + length], gtk.gdk.COLORSPACE_RGB,
+                has_alpha, 8, width, height, rowstride)
+        except (TypeError, ValueError):
+            # A corrupt entry; the icon is decoded again instead.
+            return None
+
+    def save(self, icons):
+        """Replace the file with one holding `icons`, a dictionary of
+        icon name to (stamp, pixbuf), and map the new file.
+
+        A pixbuf of None keeps the pixels of the icon loaded from the
+        file.
+        """
+        index = {}
+        chunks = []
+        offset = 0
+        for name, (stamp, pixbuf) in icons.iteritems():
+            if pixbuf is None:
+                (old_stamp, has_alpha, width, height, rowstride, old_offset,
+                 length) = self._index[name]
+                pixels = self._data[old_offset:old_offset + length]
+            else:
+                pixels = pixbuf.get_pixels()
+                has_alpha = pixbuf.get_has_alpha()
+                width = pixbuf.get_width()
+                height = pixbuf.get_height()
+                rowstride = pixbuf.get_rowstride()
+            index[name] = (
+                stamp, has_alpha, width, height, rowstride, offset,
+                len(pixels))
+            chunks.append(pixels)
+            offset += len(pixels)
+        index = marshal.dumps(index)
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        temp_filename = self.filename + '.tmp'
+        f = open(temp_filename, 'wb')
+        try:
+            f.write(MAGIC)
+            f.write(struct.pack(HEADER, len(index)))
+            f.write(index)
+            for pixels in chunks:
+                f.write(pixels)
+        finally:
+            f.close()
+        # Windows does not rename over, or remove, mapped files.
+        self.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+        os.rename(temp_filename, self.filename)
+        self.load()
+
+
+def data_digest(data):
+    """Return the digest identifying icon `data`."""
+    return md5(data).digest()
+
+
+def filename_for(directory, identity):
+    """Return the name of the cache file in `directory` for the
+    database identified by the string `identity`."""
+    if isinstance(identity, unicode):
+        identity = identity.encode('utf-8')
+    return os.path.join(directory, md5(identity).hexdigest() + '.icons')
+
+
+def _read_index(data):
+    """Return the index of the cache file mapped as `data`, with
+    offsets from the start of the file, or None if it is not a valid
+    cache."""
+    start = len(MAGIC) + struct.calcsize(HEADER)
+    if data[:len(MAGIC)] != MAGIC:
+        return None
+    try:
+        index_length, = struct.unpack(HEADER, data[len(MAGIC):start])
+        index = marshal.loads(data[start:start + index_length])
+    except (EOFError, ValueError, TypeError, struct.error):
+        return None
+    base = start + index_length
+    size = len(data)
+    # A truncated or corrupt file must not keep the database from
+    # opening; its icons are decoded again instead.
+    try:
+        for name, entry in index.items():
+            (stamp, has_alpha, width, height, rowstride, offset,
+             length) = entry
+            offset += base
+            if offset + length > size:
+                return None
+            index[name] = (
+                stamp, has_alpha, width, height, rowstride, offset, length)
+    except (AttributeError, TypeError, ValueError):
+        return None
+    return index
+
+
+optimize.bind_all(sys.modules[__name__])  # Last line of module.
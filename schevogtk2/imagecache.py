@@ -0,0 +1,143 @@
+"""Cache of decoded, optionally scaled, images."""
+
+# Copyright (c) 2001-2009 ElevenCraft Inc.
+# See LICENSE for details.
+
+import sys
+from schevo.lib import optimize
+
+from hashlib import md5
+
+import gtk
+
+from schevo.base import Entity
+from schevo.constant import UNASSIGNED
+
+from schevogtk2.background import Worker
+from schevogtk2.cache import LRUCache
+
+
+# Cached in place of a pixbuf when there is no image to show.
+NO_IMAGE = object()
+
+
+class ImageCache(object):
+    """Memory-budgeted cache of pixbufs decoded in a worker thread.
+
+    Until an image has been decoded, a transparent placeholder of the
+    requested height is returned in its place.
+    """
+
+    # Maximum number of bytes of pixel data to keep.
+    budget = 32 * 1024 * 1024
+
+    def __init__(self):
+        self._pixbufs = LRUCache(self.budget, pixbuf_size)
+        # Map of key to callbacks waiting for the key's image.
+        self._pending = {}
+        self._placeholders = {}
+        # Most recently requested images are most likely on screen.
+        self._worker = Worker('imagecache', lifo=True)
+
+    def clear(self):
+        self._pixbufs.clear()
+
+    def get(self, key, get_data, height=None, callback=None):
+        """Return the pixbuf for `key`, or a placeholder if it is not
+        decoded yet.
+
+        - `get_data`: Function returning the encoded image data, or
+          None or UNASSIGNED if there is no image; only called if the
+          image is neither cached nor being decoded.
+
+        - `height`: Height to scale the image to, or None to keep its
+          original size.
+
+        - `callback`: Function called with the pixbuf once it has been
+          decoded, if it was not already cached.
+        """
+        pixbuf = self._pixbufs.get(key)
+        if pixbuf is NO_IMAGE:
+            return None
+        elif pixbuf is not None:
+            return pixbuf
+        pending = self._pending
+        if key in pending:
+            # Each expose asks again while the image is decoding; call
+            # each callback once.
+            callbacks = pending[key]
+            if callback is not None and callback not in callbacks:
+                callbacks.append(callback)
+        else:
+            data = get_data()
+            if data is None or data is UNASSIGNED:
+                self._pixbufs[key] = NO_IMAGE
+                return None
+            callbacks = pending[key] = []
+            if callback is not None:
+                callbacks.append(callback)
+            def decoded(pixbuf):
+                self._decoded(key, pixbuf)
+            def failed(exc_type, exc_value, tb):
+                self._decoded(key, NO_IMAGE)
+            self._worker.submit(decode, (data, height), decoded, failed)
+        return self.placeholder(height)
+
+    def placeholder(self, height):
+        """Return a transparent square pixbuf of `height`, or None if
+        `height` is None."""
+        if height is None:
+            return None
+        pixbuf = self._placeholders.get(height)
+        if pixbuf is None:
+            pixbuf = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, True, 8,
+                                    height, height)
+            pixbuf.fill(0)
+            self._placeholders[height] = pixbuf
+        return pixbuf
+
+    def _decoded(self, key, pixbuf):
+        self._pixbufs[key] = pixbuf
+        if pixbuf is NO_IMAGE:
+            pixbuf = None
+        for callback in self._pending.pop(key, ()):
+            callback(pixbuf)
+
+
+def data_key(data, height=None):
+    """Return a cache key for the encoded image `data`."""
+    return ('data', md5(data).digest(), height)
+
+
+def decode(data, height=None):
+    """Return a pixbuf decoded from `data`, scaled down to `height` if
+    it is given."""
+    loader = gtk.gdk.PixbufLoader()
+    if height is not None:
+        def on_size_prepared(loader, width, original_height):
+            if original_height > height:
+                width = max(1, width * height // original_height)
+                loader.set_size(width, height)
+        loader.connect('size-prepared', on_size_prepared)
+    loader.write(data)
+    loader.close()
+    return loader.get_pixbuf()
+
+
+def image_key(instance, name, height=None):
+    """Return a cache key for the image in field `name` of `instance`,
+    or None if `instance` is not an entity."""
+    if isinstance(instance, Entity):
+        return (instance.__class__, instance._oid, instance._rev, name, height)
+
+
+def pixbuf_size(pixbuf):
+    if pixbuf is NO_IMAGE:
+        return 1
+    return pixbuf.get_rowstride() * pixbuf.get_height()
+
+
+cache = ImageCache()
+
+
+optimize.bind_all(sys.modules[__name__])  # Last line of module.
@@ -0,0 +1,78 @@
+"""Cache of the labels displayed for entities."""
+
+# Copyright (c) 2001-2009 ElevenCraft Inc.
+# See LICENSE for details.
+
+import sys
+from schevo.lib import optimize
+
+import weakref
+
+from schevo.base import Entity
+
+from schevogtk2.cache import LRUCache
+
+
+_db_map = weakref.WeakKeyDictionary()
+
+
+class LabelCache(object):
+    """Labels of the entities of a database, keyed by extent name, oid
+    and revision.
+
+    An updated entity has a new revision, so its old label is never
+    returned.  Labels often include those of referenced entities,
+    though, so every label is discarded when a transaction updates or
+    deletes entities.
+    """
+
+    # Maximum number of labels held.
+    maxsize = 20000
+
+    def __init__(self):
+        self._labels = LRUCache(self.maxsize)
+
+    def clear(self):
+        self._labels.clear()
+
+    def label(self, entity):
+        """Return the label of `entity`."""
+        key = (entity._extent.name, entity._oid, entity._rev)
+        labels = self._labels
+        if key in labels:
+            return labels[key]
+        text = labels[key] = unicode(entity)
+        return text
+
+    def reflect_changes(self, tx):
+        """Discard labels that the executed transaction `tx` may have
+        changed."""
+        summary = tx.s.summarize()
+        if summary.updates or summary.deletes:
+            self.clear()
+
+
+def entity_label(entity):
+    """Return the label of `entity`, which need not be an entity."""
+    if not isinstance(entity, Entity):
+        return unicode(entity)
+    return get_cache(entity._db).label(entity)
+
+
+def get_cache(db):
+    """Return the label cache of `db`."""
+    cache = _db_map.get(db)
+    if cache is None:
+        cache = _db_map[db] = LabelCache()
+    return cache
+
+
+def reflect_changes(db, tx):
+    """Update the label cache of `db`, if any, to reflect the executed
+    transaction `tx`."""
+    cache = _db_map.get(db)
+    if cache is not None:
+        cache.reflect_changes(tx)
+
+
+optimize.bind_all(sys.modules[__name__])  # Last line of module.
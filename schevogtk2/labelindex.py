@@ -0,0 +1,442 @@
+"""Sorted indexes of entity labels, for finding entities as users type."""
+
+# Copyright (c) 2001-2009 ElevenCraft Inc.
+# See LICENSE for details.
+
+import sys
+from schevo.lib import optimize
+
+from array import array
+from bisect import bisect_left
+import heapq
+from itertools import islice
+import time
+import weakref
+
+import gobject
+
+
+_db_map = weakref.WeakKeyDictionary()
+
+
+class LabelIndex(object):
+    """Index of the labels of the entities of an extent, built from
+    idle callbacks the first time it is searched.
+
+    Labels are indexed both in sorted order, for finding labels that
+    start with some text, and by their trigrams, for finding labels
+    that contain some text or resemble it.
+
+    Once complete, the index is kept up to date by `reflect_changes`,
+    which relabels only the entities changed by a transaction.
+
+    - `entity_label`: Function returning the label of an entity.
+    """
+
+    # Seconds spent labelling entities in each idle callback.
+    frame_budget = 0.02
+
+    # Maximum number of labels containing the trigrams of the text
+    # that are scored by rank; labels starting with the text are
+    # always scored.
+    max_candidates = 10000
+
+    # Trigrams found in more labels than this are too common to help
+    # find labels resembling the text.
+    fuzzy_posting_limit = 5000
+
+    # Fraction of the trigrams of the text that a label must share to
+    # resemble it.
+    fuzzy_threshold = 0.5
+
+    # Maximum number of labels sharing too few trigrams with the text
+    # that are checked for words misspelt in it.  Those sharing the
+    # most trigrams are checked.
+    max_misspelt_candidates = 1000
+
+    # Score added for the most recently chosen entity.
+    recent_bonus = 1.0
+
+    def __init__(self, extent, entity_label):
+        self.extent = extent
+        self.entity_label = entity_label
+        self.complete = False
+        # List of (folded label, label, oid) tuples in the order
+        # labelled, or None for entries since removed, the numbers of
+        # the entries containing each trigram, and the number of the
+        # entry of each oid.
+        self._entries = []
+        self._grams = {}
+        self._numbers = {}
+        self._removed = 0
+        # Entries sorted once complete, and their folded labels.
+        self._sorted = None
+        self._keys = None
+        self._callbacks = []
+        self._source = None
+
+    def cancel(self):
+        """Stop building the index."""
+        if self._source is not None:
+            gobject.source_remove(self._source)
+            self._source = None
+
+    def search(self, text, limit):
+        """Return a list of up to `limit` (label, oid) pairs for the
+        entities whose labels start with `text`, ignoring case.
+
+        Until the index is complete, only the entities labelled so far
+        are searched.
+        """
+        self.build()
+        folded = text.lower()
+        matches = []
+        if self.complete:
+            keys = self._keys
+            entries = self._sorted
+            position = bisect_left(keys, folded)
+            end = len(keys)
+            while (position < end and len(matches) < limit
+                   and keys[position].startswith(folded)):
+                matches.append(entries[position][1:])
+                position += 1
+        else:
+            for key, label, oid in self._entries:
+                if key.startswith(folded):
+                    matches.append((label, oid))
+                    if len(matches) >= limit:
+                        break
+            matches.sort()
+        return matches
+
+    def rank(self, text, limit, recent=()):
+        """Return a list of up to `limit` (score, label, oid) tuples for
+        the entities whose labels best match `text`, ignoring case,
+        highest score first.
+
+        Labels equal to or starting with `text` score highest, then
+        labels with a word starting with it, then labels containing
+        it or each of its words, then labels sharing most of its
+        trigrams.  Entities whose oids are in `recent`, most recently
+        chosen first, score higher.
+        """
+        self.build()
+        if isinstance(text, str):
+            text = text.decode('utf-8')
+        folded = text.lower().strip()
+        if not folded:
+            return []
+        tokens = folded.split()
+        scores = {}
+        for label, oid in self.search(folded, limit):
+            scores[oid] = (_score(folded, tokens, label.lower()), label)
+        long_tokens = [token for token in tokens if len(token) >= 3]
+        if long_tokens:
+            entries = self._entries
+            numbers = self._candidates(long_tokens)
+            for number in islice(numbers, self.max_candidates):
+                entry = entries[number]
+                if entry is None:
+                    continue
+                key, label, oid = entry
+                if oid not in scores:
+                    score = _score(folded, tokens, key)
+                    if score:
+                        scores[oid] = (score, label)
+            if len(scores) < limit:
+                self._add_resembling(folded, scores)
+        if recent:
+            bonus = self.recent_bonus
+            count = len(recent)
+            for position, oid in enumerate(recent):
+                if oid in scores:
+                    score, label = scores[oid]
+                    score += bonus * (count - position) / count
+                    scores[oid] = (score, label)
+        best = heapq.nsmallest(
+            limit,
+            [(-score, label, oid)
+             for oid, (score, label) in scores.iteritems()])
+        return [(-score, label, oid) for score, label, oid in best]
+
+    def build(self, callback=None):
+        """Start building the index, if it is not built or being built,
+        and call `callback` once it is complete."""
+        if self.complete:
+            if callback is not None:
+                callback(self)
+            return
+        if callback is not None and callback not in self._callbacks:
+            self._callbacks.append(callback)
+        if self._source is None:
+            entities = self._label_entities()
+            self._source = gobject.idle_add(
+                entities.next, priority=gobject.PRIORITY_LOW)
+
+    def reflect_changes(self, summary):
+        """Update the complete index to reflect the transaction summary
+        `summary`."""
+        extent = self.extent
+        name = extent.name
+        deleted = set(summary.deletes.get(name, []))
+        for oid in deleted:
+            self._remove(oid)
+        for oid in summary.updates.get(name, []):
+            if oid not in deleted:
+                self._remove(oid)
+                self._add(extent[oid])
+        for oid in summary.creates.get(name, []):
+            if oid not in deleted:
+                self._add(extent[oid])
+        if self._removed > len(self._numbers):
+            self._compact()
+
+    def _add(self, entity):
+        label = unicode(self.entity_label(entity))
+        entry = (label.lower(), label, entity._oid)
+        entries = self._entries
+        self._index_entry(len(entries), entry)
+        entries.append(entry)
+        position = bisect_left(self._sorted, entry)
+        self._sorted.insert(position, entry)
+        self._keys.insert(position, entry[0])
+
+    def _add_resembling(self, folded, scores):
+        """Add the entries sharing most of the trigrams of `folded` to
+        `scores`, and those with the words of `folded` misspelt."""
+        grams = trigrams(u' %s ' % folded)
+        if not grams:
+            return
+        index_grams = self._grams
+        posting_limit = self.fuzzy_posting_limit
+        counts = {}
+        for gram in grams:
+            postings = index_grams.get(gram)
+            if postings is None or len(postings) > posting_limit:
+                continue
+            for number in postings:
+                counts[number] = counts.get(number, 0) + 1
+        total = float(len(grams))
+        required = self.fuzzy_threshold * total
+        entries = self._entries
+        near = []
+        for number, count in counts.iteritems():
+            entry = entries[number]
+            if entry is None or entry[2] in scores:
+                continue
+            if count >= required:
+                scores[entry[2]] = (0.4 * count / total, entry[1])
+            else:
+                near.append((count, number))
+        # Words with transposed, missing or extra letters share few
+        # trigrams with the words meant, so the labels sharing some
+        # are checked for words within a few edits of each word.
+        tokens = folded.split()
+        for count, number in heapq.nlargest(
+            self.max_misspelt_candidates, near):
+            key, label, oid = entries[number]
+            edits = _misspelt_edits(tokens, key.split())
+            if edits is not None:
+                scores[oid] = (0.3 / (1 + edits), label)
+
+    def _candidates(self, tokens):
+        """Return the set of numbers of the entries containing every
+        trigram of `tokens`."""
+        index_grams = self._grams
+        postings = []
+        for token in tokens:
+            for gram in trigrams(token):
+                numbers = index_grams.get(gram)
+                if numbers is None:
+                    return set()
+                postings.append(numbers)
+        postings.sort(key=len)
+        candidates = set(postings[0])
+        for numbers in postings[1:]:
+            if not candidates:
+                break
+            candidates.intersection_update(numbers)
+        return candidates
+
+    def _compact(self):
+        """Renumber the entries, leaving out those removed."""
+        entries = self._entries = [
+            entry for entry in self._entries if entry is not None]
+        self._grams = {}
+        self._numbers = {}
+        self._removed = 0
+        index_entry = self._index_entry
+        for number, entry in enumerate(entries):
+            index_entry(number, entry)
+
+    def _index_entry(self, number, entry):
+        """Index the trigrams and oid of `entry`, numbered `number`."""
+        index_grams = self._grams
+        # Padded, so that the starts and ends of words are indexed.
+        for gram in trigrams(u' %s ' % entry[0]):
+            postings = index_grams.get(gram)
+            if postings is None:
+                postings = index_grams[gram] = array('i')
+            postings.append(number)
+        self._numbers[entry[2]] = number
+
+    def _label_entities(self):
+        entity_label = self.entity_label
+        entries = self._entries
+        index_entry = self._index_entry
+        budget = self.frame_budget
+        deadline = time.time() + budget
+        for entity in self.extent:
+            label = unicode(entity_label(entity))
+            entry = (label.lower(), label, entity._oid)
+            index_entry(len(entries), entry)
+            entries.append(entry)
+            if time.time() >= deadline:
+                yield True
+                deadline = time.time() + budget
+        self._sorted = sorted(entries)
+        self._keys = [entry[0] for entry in self._sorted]
+        self.complete = True
+        self._source = None
+        callbacks = self._callbacks
+        self._callbacks = []
+        for callback in callbacks:
+            callback(self)
+        yield False
+
+    def _remove(self, oid):
+        number = self._numbers.pop(oid, None)
+        if number is None:
+            return
+        entries = self._entries
+        entry = entries[number]
+        # Postings of removed entries are skipped until compacted.
+        entries[number] = None
+        self._removed += 1
+        position = bisect_left(self._sorted, entry)
+        del self._sorted[position]
+        del self._keys[position]
+
+
+def get_index(extent, entity_label):
+    """Return the label index of `extent` for `entity_label`."""
+    indexes = _db_map.get(extent.db)
+    if indexes is None:
+        indexes = _db_map[extent.db] = {}
+    key = (extent.name, entity_label)
+    index = indexes.get(key)
+    if index is None:
+        index = indexes[key] = LabelIndex(extent, entity_label)
+    return index
+
+
+def edit_distance(a, b, limit):
+    """Return the number of single-character insertions, deletions,
+    substitutions and transpositions of adjacent characters turning
+    `a` into `b`, or None if more than `limit` are needed."""
+    if abs(len(a) - len(b)) > limit:
+        return None
+    previous = None
+    row = range(len(b) + 1)
+    for i in xrange(1, len(a) + 1):
+        before, previous = previous, row
+        row = [i]
+        for j in xrange(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            distance = min(previous[j] + 1, row[j - 1] + 1,
+                           previous[j - 1] + cost)
+            if (i > 1 and j > 1 and a[i - 1] == b[j - 2]
+                and a[i - 2] == b[j - 1]):
+                distance = min(distance, before[j - 2] + 1)
+            row.append(distance)
+        if min(row) > limit:
+            return None
+    if row[-1] > limit:
+        return None
+    return row[-1]
+
+
+def trigrams(text):
+    """Return the set of three-character substrings of `text`."""
+    return set([text[i:i + 3] for i in xrange(len(text) - 2)])
+
+
+def _misspelt_edits(tokens, words):
+    """Return the total number of edits turning each of `tokens` into
+    one of `words` or the start of one, or None if a token is too far
+    from every word.
+
+    Tokens of up to five characters may be one edit away, longer
+    tokens two.
+    """
+    total = 0
+    for token in tokens:
+        if len(token) < 3:
+            limit = 0
+        elif len(token) <= 5:
+            limit = 1
+        else:
+            limit = 2
+        best = None
+        for word in words:
+            if word.startswith(token):
+                best = 0
+                break
+            for candidate in (word, word[:len(token)]):
+                edits = edit_distance(token, candidate, limit)
+                if edits is not None and (best is None or edits < best):
+                    best = edits
+        if best is None:
+            return None
+        total += best
+    return total
+
+
+def _score(folded, tokens, key):
+    """Return the score of the folded label `key` for the folded text
+    `folded` and its words `tokens`, or 0 if it does not contain them.
+    """
+    position = key.find(folded)
+    if position == 0:
+        if len(key) == len(folded):
+            base = 4.0
+        else:
+            base = 3.0
+    elif position > 0:
+        if key[position - 1].isalnum():
+            base = 1.0
+        else:
+            base = 2.0
+    else:
+        for token in tokens:
+            if token not in key:
+                return 0
+        base = 0.5
+    # Shorter labels match more closely.
+    return base + 0.25 / len(key)
+
+
+def reflect_changes(db, tx):
+    """Update the indexes of extents changed by the executed
+    transaction `tx`.
+
+    Indexes still being built are discarded, since the entities not
+    yet labelled may or may not be found by the build.
+    """
+    indexes = _db_map.get(db)
+    if not indexes:
+        return
+    summary = tx.s.summarize()
+    changed = set(summary.creates)
+    changed.update(summary.deletes)
+    changed.update(summary.updates)
+    for key in indexes.keys():
+        if key[0] in changed:
+            index = indexes[key]
+            if index.complete:
+                index.reflect_changes(summary)
+            else:
+                indexes.pop(key).cancel()
+
+
+optimize.bind_all(sys.modules[__name__])  # Last line of module.
@@ -30,6 +30,7 @@ class NavigatorWindow(Window):
         file_open_title = 'Open Schevo Database File'
 
     def __init__(self):
+        self._entity_grid_text = u''
         Window.__init__(self)
         self.update_ui()
 
@@ -60,7 +61,15 @@ class NavigatorWindow(Window):
         widget = self.entity_grid
         self._on_action_selected(widget, action)
 
+    def on_entity_grid__population_progress(self, widget, count, total):
+        text = self._entity_grid_text
+        if count < total:
+            text = u'%s (%i of %i)' % (text, count, total)
+        self.entity_grid_label.set_text(text)
+
     def on_extent_grid__selection_changed(self, widget, extent):
+        # Stop filling the grid with rows of the previous extent.
+        self.entity_grid.cancel_population()
         if extent is not None:
             with TemporaryCursor(self):
                 self._db.backend.rollback()
@@ -68,9 +77,14 @@ class NavigatorWindow(Window):
                 size = gtk.ICON_SIZE_LARGE_TOOLBAR
                 self.entity_grid_image.set_from_icon_set(icon_set, size)
                 text = u'List of %s:' % plural(extent)
+                self._entity_grid_text = text
                 self.entity_grid_label.set_text(text)
                 self.entity_grid.set_extent(extent)
 
+    def reflect_changes(self, result, tx):
+        # Show the updated quantities of extents.
+        self.extent_grid.redraw()
+
     def update_title(self):
         """Add or remove the database label from the end of the title."""
         separator = u' :: '
@@ -6,27 +6,70 @@
 import sys
 from schevo.lib import optimize
 
+import weakref
+
+from schevo.base import Entity, Extent
+
 custom_tx_dialog_handlers = []
 custom_view_dialog_handlers = []
 
-def add_custom_tx_dialog_handler(handler):
+# Handlers whose decisions are kept, since they depend only on the
+# database, the action and the extent of its instance.
+_cached_handlers = set()
+
+# Map of database to a map of (handler, action key) to the dialog
+# class returned by the handler.
+_decision_map = weakref.WeakKeyDictionary()
+
+def add_custom_tx_dialog_handler(handler, cache=False):
     custom_tx_dialog_handlers.append(handler)
+    if cache:
+        _cached_handlers.add(handler)
 
 def get_custom_tx_dialog_class(db, action):
     for handler in custom_tx_dialog_handlers:
-        customClass = handler(db, action)
+        customClass = _decide(handler, db, action)
         if customClass is not None:
             return customClass
 
 
-def add_custom_view_dialog_handler(handler):
+def add_custom_view_dialog_handler(handler, cache=False):
     custom_view_dialog_handlers.append(handler)
+    if cache:
+        _cached_handlers.add(handler)
 
 def get_custom_view_dialog_class(db, action):
     for handler in custom_view_dialog_handlers:
-        customClass = handler(db, action)
+        customClass = _decide(handler, db, action)
         if customClass is not None:
             return customClass
 
 
+def _action_key(action):
+    # Actions on entities of the same extent share decisions.
+    instance = action.instance
+    if isinstance(instance, Entity):
+        owner = (Entity, instance._extent.name)
+    elif isinstance(instance, Extent):
+        owner = (Extent, instance.name)
+    else:
+        owner = instance.__class__
+    return (action.type, action.name, owner)
+
+def _decide(handler, db, action):
+    """Return the dialog class that `handler` returns for `db` and
+    `action`, calling it only once for each kind of action if it was
+    added with `cache=True`."""
+    if handler not in _cached_handlers:
+        return handler(db, action)
+    decisions = _decision_map.get(db)
+    if decisions is None:
+        decisions = _decision_map[db] = {}
+    key = (handler, _action_key(action))
+    if key in decisions:
+        return decisions[key]
+    customClass = decisions[key] = handler(db, action)
+    return customClass
+
+
 optimize.bind_all(sys.modules[__name__])  # Last line of module.
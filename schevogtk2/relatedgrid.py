@@ -9,6 +9,7 @@ from schevo.lib import optimize
 from schevo.label import label, plural
 
 from schevogtk2 import action
+from schevogtk2 import counts
 from schevogtk2 import grid
 from schevogtk2 import icon
 from schevogtk2.utils import gsignal, type_register
@@ -68,7 +69,7 @@ class RelatedGrid(grid.Grid):
         columns.append(column)
         column = grid.Column(self, 'field_label', 'Field', str)
         columns.append(column)
-        column = grid.Column(self, '__len__', 'Qty', int, call=True)
+        column = grid.CountColumn(self, 'Qty', related_count_info)
         columns.append(column)
         self.set_columns(columns)
 
@@ -170,4 +171,10 @@ class PopupMenu(grid.PopupMenu):
         self._related_grid.select_action(action)
 
 
+def related_count_info(related):
+    key = counts.links_key(
+        related.entity, related.extent.name, related.field_name)
+    return related.entity._db, key
+
+
 optimize.bind_all(sys.modules[__name__])  # Last line of module.
@@ -10,6 +10,7 @@ from xml.sax.saxutils import escape
 
 from schevo.label import label, plural
 
+from schevogtk2.labelcache import entity_label
 from schevogtk2.window import Window
 
 
@@ -22,7 +23,7 @@ class RelationshipWindow(Window):
         self._db = db
         self._entity = entity
         extent_text = label(entity.s.extent)
-        text = u'%s :: %s' % (extent_text, entity)
+        text = u'%s :: %s' % (extent_text, entity_label(entity))
         markup = u'<b>%s</b>' % escape(text)
         self.header_label.set_markup(markup)
         self.related_grid.show_hidden_extents = True
@@ -50,5 +51,9 @@ class RelationshipWindow(Window):
             self.entity_grid_label.set_text(text)
             self.entity_grid.set_related(related)
 
+    def reflect_changes(self, result, tx):
+        # Show the updated quantities of related entities.
+        self.related_grid.redraw()
+
 
 optimize.bind_all(sys.modules[__name__])  # Last line of module.
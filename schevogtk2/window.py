@@ -189,7 +189,7 @@ class BaseWindow(object):
                 )
         dialog.run()
         tx_result = dialog.tx_result
-        dialog.destroy()
+        form.release_dialog(dialog)
         return tx_result
 
     def run_view_dialog(self, entity, action):
@@ -201,7 +201,7 @@ class BaseWindow(object):
                 self.get_value_handlers, self.set_field_handlers,
                 )
         dialog.run()
-        dialog.destroy()
+        form.release_dialog(dialog)
 
     def _set_bindings(self):
         items = [
@@ -255,6 +255,7 @@ class Window(BaseWindow):
     def __init__(self):
         BaseWindow.__init__(self)
         self._db_filename = None
+        self._icon_warm_up = None
 
     def create_backup(self, filename):
         if os.path.isfile(filename):
@@ -278,6 +279,10 @@ class Window(BaseWindow):
         """Close an existing database file."""
         if self._db is not None:
             with TemporaryCursor(self):
+                if self._icon_warm_up is not None:
+                    self._icon_warm_up.cancel()
+                    self._icon_warm_up = None
+                form.dialog_pool.discard(self._db)
                 self._db.close()
                 self._db = None
                 self._db_filename = None
@@ -299,6 +304,9 @@ class Window(BaseWindow):
             else:
                 self._db_filename = filename
                 self.update_ui()
+                # Have icons ready before grids first draw them.
+                self._icon_warm_up = icon.warm_up(
+                    self._db, os.path.abspath(filename))
 
     def database_pack(self):
         """Pack the currently open database file."""